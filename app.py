@@ -4,21 +4,27 @@ import argparse
 import subprocess
 import yaml
 import os
-import glob
 import time
-import shutil
 import sqlite3
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as ET
 import gdrive_adapter
+import rsync_adapter
 import metadata_util
+import file_util
+import repo_db
 from app_info import AppInfo
 from app_config import AppConfig
 
 appInfo = AppInfo()
 appConfig = AppConfig(appInfo)
 IGNORE_FILE = ".pixignore"
+# the journal row holding the filter digest, .pixync is never a pushed directory
+JOURNAL_FILTER_PATH = ".pixync"
 GDRIVE_REPO_PREFIX = 'gdrive:'
 BANNER_WIDTH = 75
+IMPORT_JOBS = 4
 config_settings_global = None
 config_settings_local = None
 
@@ -262,11 +268,12 @@ def cmd_config_show(section):
         print('local config: ')
         print(yaml.dump(config_settings_local))
 
-    for file in glob.iglob(local_repo_path + "**/*.jpg", recursive=True):
-        print(file, ":", metadata_util.get_rating_embed(file)
-)
+    repo_index = metadata_util.scan_repo(local_repo_path, metadata_util.read_patterns(local_repo_path + IGNORE_FILE))
+    for file in repo_index['files']:
+        if file.endswith('.jpg'):
+            print(local_repo_path + file, ":", metadata_util.get_rating_embed(local_repo_path + file))
 
-def cmd_pull(remote_repo_name, delete, dry_run, rating):
+def cmd_pull(remote_repo_name, delete, dry_run, rating, parallel=1):
     repos = get_remote_repos(True)
     repo = get_repo(repos, remote_repo_name)
 
@@ -301,38 +308,74 @@ def cmd_pull(remote_repo_name, delete, dry_run, rating):
         print_function_footer()
         exit(0)
 
-    rsync_command = ['rsync','-urtW', 
-        '--exclude=.pixync/','--exclude=.trash/', 
-        '--exclude-from=' + local_repo_path + IGNORE_FILE, 
-        remote_repo_url, local_repo_path]
+    rsync_adapter.local_repo_path = local_repo_path
+    rsync_adapter.verbose = verbose
+    rsync_adapter.quiet = quiet
+    rsync_adapter.set_config(config_settings_global)
 
-    if not quiet:
-        rsync_command.insert(2,'-v')
-        rsync_command.insert(2,'--progress')
-    
-    if delete:
-        rsync_command.insert(2,'--delete')
+    if delete and parallel > 1:
+        print('--delete is not supported together with --parallel.')
+        exit(1)
 
-    if dry_run:
-        rsync_command.insert(2,'--dry-run')
+    if delete and rating:
+        print('--delete is not supported together with --rating.')
+        exit(1)
 
-    if os.path.exists(local_repo_path + appConfig.delete_log_path):
-        rsync_command.insert(2,'--exclude-from=' + local_repo_path + appConfig.delete_log_path)
+    if rsync_adapter.pull(remote_repo_name, remote_repo_url, delete, dry_run, rating, parallel) != 0:
+        print("Pull from '{}' to '{}' failed.".format(remote_repo_url, local_repo_path))
+        exit(1)
 
-    subprocess.call(rsync_command)
     set_last_activity_time('pull', remote_repo_name)
 
     print_function_footer()
     print ("Pull from '{}' to '{}' completed.".format(remote_repo_url, local_repo_path))
 
-def cmd_push(remote_repo_name, delete, forced_delete, dry_run, rating):
-    repos = get_remote_repos(True)
-    repo = get_repo(repos, remote_repo_name)
+def set_push_context(jobs=1):
+    gdrive_adapter.local_repo_path = local_repo_path
+    gdrive_adapter.verbose = verbose
+    gdrive_adapter.quiet = quiet
+    gdrive_adapter.jobs = jobs
+    gdrive_adapter.set_config(config_settings_global)
 
-    if repo == None:
-        print("remote repository '{}' not found.".format(remote_repo_name))
-        exit(1)
+    rsync_adapter.local_repo_path = local_repo_path
+    rsync_adapter.verbose = verbose
+    rsync_adapter.quiet = quiet
+    rsync_adapter.jobs = jobs
+    rsync_adapter.set_config(config_settings_global)
+
+def get_journal_key(repo, rating, delete):
+    return '{}:{}{}'.format(repo['name'], rating, ':delete' if delete else '')
+
+def get_filter_digest(repo):
+    # the ignore patterns and rating settings decide which files a push carries, so a change to them voids the journal
+    digest = hashlib.blake2b(digest_size=16)
+    ignore_file = local_repo_path + IGNORE_FILE
+    if os.path.exists(ignore_file):
+        with open(ignore_file, 'rb') as file:
+            digest.update(file.read())
+    settings = [config_settings_global.get('ignore-ratings', []), config_settings_global.get('embedded-ratings', False), repo.get('sidecar-bundles', False)]
+    digest.update(repr(settings).encode('utf-8'))
+    return digest.hexdigest()
+
+def get_changed_dirs(journal_key, digests, filter_digest):
+    conn = repo_db.connect(local_repo_path)
+    journal = repo_db.get_push_journal(conn, journal_key)
+    conn.close()
+    if journal.get(JOURNAL_FILTER_PATH) != filter_digest:
+        return set(digests)
+    return set(path for path, (mtime, digest) in digests.items() if journal.get(path) != digest)
 
+def set_push_journal(journal_key, digests, filter_digest):
+    conn = repo_db.connect(local_repo_path)
+    repo_db.set_push_journal(conn, journal_key, dict(digests, **{JOURNAL_FILTER_PATH: (0, filter_digest)}))
+    conn.commit()
+    conn.close()
+
+def compact_tombstones(repos):
+    # GDrive remotes never apply deletions, so only the rsync remotes are waited on
+    rsync_adapter.compact_tombstones([repo['name'] for repo in repos if not repo['url'].startswith(GDRIVE_REPO_PREFIX)])
+
+def push_remote(repo, delete, forced_delete, dry_run, rating, parallel=None, digests=None):
     remote_repo_url = get_path_with_trailing_slash(repo['url'])
 
     if rating is None:
@@ -341,71 +384,130 @@ def cmd_push(remote_repo_name, delete, forced_delete, dry_run, rating):
         else:   
             rating = 0
 
+    if parallel is None:
+        parallel = repo.get('parallel', gdrive_adapter.TRANSFER_WORKERS if repo['url'].startswith(GDRIVE_REPO_PREFIX) else 1)
+
     if verbose:
         print("---push---")
         print('remote_repo_url: ', remote_repo_url)
         print('local_repo_path: ', local_repo_path)
         print('rating >= ', rating)
-    
+
+    if forced_delete and parallel > 1 and not repo['url'].startswith(GDRIVE_REPO_PREFIX):
+        print('--forced-delete is not supported together with --parallel.')
+        return 1
+
+    # directories whose digest matches the last push to this remote are left out
+    journal_key = get_journal_key(repo, rating, delete)
+    filter_digest = get_filter_digest(repo)
+    changed_dirs = None
+    if digests is not None and not forced_delete:
+        changed_dirs = get_changed_dirs(journal_key, digests, filter_digest)
+        if '' not in changed_dirs:
+            print("'{}' is up to date.".format(repo['name']))
+            return 0
+        if verbose: print('{} of {} directories changed'.format(len(changed_dirs), len(digests)))
+
     if repo['url'].startswith(GDRIVE_REPO_PREFIX):
-        gdrive_adapter.local_repo_path = local_repo_path
-        gdrive_adapter.verbose = verbose
-        gdrive_adapter.quiet = quiet
         gdrive_adapter.gdrive_repo_url = repo['url'][len(GDRIVE_REPO_PREFIX):].rstrip('/').split('/', 1)
-        gdrive_adapter.set_config(config_settings_global)
         gdrive_adapter.set_client_credentials(access_token)
-        gdrive_adapter.upload_to_gdrive(rating)
-        exit(0)
-
-    rsync_command = ['rsync','-urtW',
-        '--exclude=.pixync/','--exclude=.trash/',
-        '--exclude-from=' + local_repo_path + IGNORE_FILE, 
-        local_repo_path, remote_repo_url]
-
-    if not quiet:
-        rsync_command.insert(2,'-v')
-        rsync_command.insert(2,'--progress')
-
-    if forced_delete:
-        rsync_command.insert(2,'--delete')
-
-
-    if dry_run:
-        rsync_command.append('--dry-run')
-        
-    subprocess.call(rsync_command)
-
-    rsync_commit_command = ['rsync','-urtW',
-        '--include=.commit/',
-        '--exclude=*.*', 
-        local_repo_path, remote_repo_url]
-
-    if not quiet:
-        rsync_commit_command.insert(2,'-v')
-        rsync_commit_command.insert(2,'--progress')
+        gdrive_adapter.changed_dirs = changed_dirs
+        gdrive_adapter.workers = parallel
+        gdrive_adapter.set_transfer_config(repo)
+        try:
+            gdrive_adapter.upload_to_gdrive(rating)
+            returncode = 0
+        except SystemExit as e:
+            returncode = e.code or 1
+    else:
+        returncode = rsync_adapter.push(repo['name'], remote_repo_url, rating, delete, forced_delete, dry_run, parallel, changed_dirs)
+
+    if returncode == 0 and digests is not None and not dry_run:
+        set_push_journal(journal_key, digests, filter_digest)
+    return returncode
+
+def push_remotes(push_repos, delete, forced_delete, dry_run, rating, parallel=None, digests=None):
+    # the GDrive adapter keeps its session in module state, so GDrive remotes share a single lane
+    rsync_repos = [repo for repo in push_repos if not repo['url'].startswith(GDRIVE_REPO_PREFIX)]
+    gdrive_repos = [repo for repo in push_repos if repo['url'].startswith(GDRIVE_REPO_PREFIX)]
+
+    def timed_push(repo):
+        start_time = time.time()
+        returncode = push_remote(repo, delete, forced_delete, dry_run, rating, parallel, digests)
+        return returncode, time.time() - start_time
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max(len(rsync_repos), 1)) as rsync_executor, ThreadPoolExecutor(max_workers=1) as gdrive_executor:
+        for repo in rsync_repos:
+            futures[repo['name']] = rsync_executor.submit(timed_push, repo)
+        for repo in gdrive_repos:
+            futures[repo['name']] = gdrive_executor.submit(timed_push, repo)
+
+    results = {}
+    for repo in push_repos:
+        try:
+            results[repo['name']] = futures[repo['name']].result()
+        except Exception as e:
+            print("Push to '{}' failed: {}".format(repo['name'], e))
+            results[repo['name']] = (1, 0)
+    return results
+
+def cmd_push(remote_repo_names, all_remotes, delete, forced_delete, dry_run, rating, jobs=1, parallel=None, full=False):
+    repos = get_remote_repos(True)
 
-    if dry_run:
-        rsync_commit_command.append('--dry-run')
+    if all_remotes:
+        push_repos = repos
+    else:
+        push_repos = []
+        for remote_repo_name in remote_repo_names:
+            repo = get_repo(repos, remote_repo_name)
+            if repo == None:
+                print("remote repository '{}' not found.".format(remote_repo_name))
+                exit(1)
+            push_repos.append(repo)
+
+    if not push_repos:
+        print("no remote repository to push to.")
+        exit(1)
 
-    subprocess.call(rsync_commit_command)
+    set_push_context(jobs)
+    digests = None if full else file_util.get_dir_digests(local_repo_path)
 
-    if delete and os.path.exists(local_repo_path + appConfig.delete_log_path):
-        rsync_delete_command = ['rsync', '-urtW', '--delete', 
-            '--include-from=' + local_repo_path + appConfig.delete_log_path, 
-            '--exclude=*.*', local_repo_path, remote_repo_url]
-        if not quiet:
-            rsync_delete_command.insert(2,'-v')
-            rsync_delete_command.insert(2,'--progress')
-        
-        if dry_run:
-            rsync_delete_command.append('--dry-run')
+    if len(push_repos) == 1:
+        repo = push_repos[0]
+        remote_repo_url = get_path_with_trailing_slash(repo['url'])
+        if push_remote(repo, delete, forced_delete, dry_run, rating, parallel, digests) != 0:
+            print("Push from '{}' to '{}' failed.".format(local_repo_path, remote_repo_url))
+            exit(1)
 
-        subprocess.call(rsync_delete_command)
+        set_last_activity_time('push', repo['name'])
+        compact_tombstones(repos)
+        print ("Push from '{}' to '{}' complete.".format(local_repo_path, remote_repo_url))
+        return
 
-    set_last_activity_time('push', remote_repo_name)
+    # scan and rate the local tree once for all remotes
+    repo_index = metadata_util.scan_repo(local_repo_path,
+        metadata_util.read_patterns(local_repo_path + IGNORE_FILE), config_settings_global.get('ignore-ratings', []))
+    metadata_util.get_index_ratings(local_repo_path, repo_index, config_settings_global.get('embedded-ratings', False), jobs)
+    gdrive_adapter.repo_index = repo_index
+    rsync_adapter.repo_index = repo_index
+    rsync_adapter.quiet = True
+
+    start_time = time.time()
+    results = push_remotes(push_repos, delete, forced_delete, dry_run, rating, parallel, digests)
+
+    print("{:-<75}".format(''))
+    for repo in push_repos:
+        returncode, duration = results[repo['name']]
+        if returncode == 0: set_last_activity_time('push', repo['name'])
+        print('{:<20}{:<40}{:>7}{:>7.0f}s'.format(repo['name'], repo['url'][:39], 'ok' if returncode == 0 else 'failed', duration))
+    print("{:-<75}".format(''))
+    compact_tombstones(repos)
+    print("Push to {} remotes completed in {:.0f}s.".format(len(push_repos), time.time() - start_time))
+
+    if any(results[repo['name']][0] != 0 for repo in push_repos):
+        exit(1)
 
-    print ("Push from '{}' to '{}' complete.".format(local_repo_path, remote_repo_url))
-    
 def cmd_clone(remote_repo_url, remote_repo_name):
     global config_settings_local
 
@@ -445,73 +547,240 @@ def cmd_init():
 
     print('Local repository {} initialized successfully.'.format(local_repo_path))
 
-def cmd_import(media_source_path, cam_name, delete_source_files=False):
+def get_import_files(media_source_path):
+    for dir_path, dir_names, file_names in os.walk(media_source_path):
+        dir_names[:] = sorted(d for d in dir_names if not d.startswith('.'))
+        for file_name in sorted(file_names):
+            if not file_name.startswith('.') and '.' in file_name:
+                yield os.path.join(dir_path, file_name)
+
+def is_duplicate(conn, source, candidate):
+    if not os.path.exists(candidate[0]):
+        return False
+
+    if candidate[1] is None: candidate[1] = file_util.get_partial_hash(candidate[0])
+    if source[1] is None: source[1] = file_util.get_partial_hash(source[0])
+    if candidate[1] != source[1]:
+        return False
+
+    if candidate[2] is None:
+        candidate[2] = file_util.get_full_hash(candidate[0])
+        if candidate[3]: repo_db.set_full_hash(conn, candidate[3], candidate[2])
+    if source[2] is None: source[2] = file_util.get_full_hash(source[0])
+    return candidate[2] == source[2]
+
+def is_hashed(file):
+    # sidecars are edited in place, so a stored hash of one goes stale and they stay out of the index
+    return os.path.splitext(file)[1].lower() not in metadata_util.SIDECAR_EXTENSIONS
+
+def find_duplicate(conn, file, planned_hashes):
+    # entries are [path, partial hash, full hash, repo relative path], hashes are computed only on a size collision
+    size = os.path.getsize(file)
+    source = [file, None, None, None]
+
+    candidates = [[local_repo_path + path, partial_hash, full_hash, path] for path, partial_hash, full_hash in repo_db.get_hashes_by_size(conn, size)]
+
+    # files trashed or removed since they were indexed are dropped from the index on first sight
+    missing = [candidate for candidate in candidates if not os.path.exists(candidate[0])]
+    if missing:
+        repo_db.remove_hashes(conn, [candidate[3] for candidate in missing])
+        candidates = [candidate for candidate in candidates if candidate not in missing]
+
+    for candidate in candidates + planned_hashes.get(size, []):
+        if is_duplicate(conn, source, candidate):
+            return candidate[0]
+
+    planned_hashes.setdefault(size, []).append(source)
+    return None
+
+def import_file(file, dest, delete_source_files):
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+    # the plan only holds free destinations, anything there now appeared during the run
+    if os.path.exists(dest):
+        raise OSError("name clash for '{}'".format(dest))
+    file_util.copy_file(file, dest, delete_source_files)
+
+    if not file_util.is_same_file(file, dest):
+        raise OSError("verification failed for '{}'".format(dest))
+
+    # size and mtime are carried over by the copy, only the content proves it before the source goes
+    full_hash = None
+    if delete_source_files:
+        full_hash = file_util.get_full_hash(dest)
+        if file_util.get_full_hash(file) != full_hash:
+            raise OSError("content verification failed for '{}'".format(dest))
+        os.remove(file)
+
+    return dest, os.path.getsize(dest), file_util.get_partial_hash(dest), full_hash
+
+def cmd_import(media_source_path, cam_name, delete_source_files=False, jobs=IMPORT_JOBS):
+    if not cam_name:
+        print("camera name is required to import files.")
+        exit(1)
+
     ext_mappings = {}
     for cat_key, cat_value in config_settings_global['ext-mappings'].items():
         for subcat_key, subcat_value in cat_value.items():
             for ext in subcat_value:
                 ext_mappings[ext] = cat_key + os.path.sep + subcat_key
 
-    local_temp_dir = local_repo_path + os.path.sep + '__CACHE__'
-
     if verbose:
         print("---import---")
         print("media_source_path:\t", media_source_path)
         print("local_repo_path:\t", local_repo_path)
 
-    rsync_command = ['rsync', '-urtW', media_source_path, local_temp_dir]
+    conn = repo_db.connect(local_repo_path)
+    import_plan = {}
+    planned_hashes = {}
+    skipped = 0
+    failed = 0
+    deleted = 0
+    for file in get_import_files(media_source_path):
+        duplicate = find_duplicate(conn, file, planned_hashes) if is_hashed(file) else None
+        if duplicate:
+            skipped += 1
+            if verbose: print('> {:<60}{:>13}'.format(os.path.relpath(file, media_source_path), 'duplicate'))
+            if delete_source_files and duplicate.startswith(local_repo_path):
+                os.remove(file)
+                deleted += 1
+            continue
 
-    if not quiet:
-        rsync_command.insert(2,'-v')
-        rsync_command.insert(2,'--progress')
-
-    if delete_source_files:
-        rsync_command.insert(2,'--remove-source-files')
-
-    if verbose: print('Caching the files in the local repo path.')
-    subprocess.call(rsync_command)
-    if verbose: print('Caching the files in the local repo path completed.')
-
-    if verbose: print('Moving & Renaming files in the local repo.')
-    import_log = open(local_repo_path + appConfig.import_log_path, "a")
-    for file in glob.iglob(local_temp_dir + '/**/*.*', recursive=True):
         creation_date = get_creation_date(file)
         file_extension = os.path.splitext(file)[1]
         dest_sub_dir = local_repo_path + get_path_by_ext(ext_mappings, file_extension)
         dest = dest_sub_dir+ os.path.sep + creation_date + '_'+ cam_name + '_' + os.path.basename(file)
-        os.makedirs(dest_sub_dir, exist_ok=True)
-        os.rename(file, dest)
-        import_log.write(os.path.relpath(dest, local_repo_path))
-        import_log.write('\n')
-    import_log.close()
-    if verbose: print('Moving & Renaming files in the local repo completed.')
+        # card folders restart their numbering, two different files of one day can land on the same name,
+        # within one run or across runs, and a file in the repo is never replaced by different content
+        full_hash = None
+        if dest not in import_plan and os.path.exists(dest):
+            full_hash = file_util.get_full_hash(dest)
+        if dest in import_plan or (full_hash is not None and full_hash != file_util.get_full_hash(file)):
+            failed += 1
+            print('> {:<60}{:>13}'.format(os.path.relpath(file, media_source_path), 'name clash'))
+            continue
+
+        if full_hash is not None:
+            # copied by an earlier run that stopped before indexing it
+            skipped += 1
+            if is_hashed(dest): repo_db.set_hashes(conn, [(os.path.relpath(dest, local_repo_path), os.path.getsize(dest), file_util.get_partial_hash(dest), full_hash)])
+            if verbose: print('> {:<60}{:>13}'.format(os.path.relpath(file, media_source_path), 'duplicate'))
+            if delete_source_files:
+                os.remove(file)
+                deleted += 1
+            continue
+        import_plan[dest] = file
+    conn.commit()
 
-    if verbose: print('Removing temporary files & directories.')
-    shutil.rmtree(local_temp_dir)
+    if verbose: print('Copying {} files into the local repo.'.format(len(import_plan)))
+    import_log = open(local_repo_path + appConfig.import_log_path, "a")
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [executor.submit(import_file, file, dest, delete_source_files) for dest, file in import_plan.items()]
+        for future in futures:
+            try:
+                dest, size, partial_hash, full_hash = future.result()
+            except OSError as e:
+                failed += 1
+                print('> {:<60}{:>13}'.format(str(e), 'failed'))
+                continue
+
+            if delete_source_files: deleted += 1
+            if is_hashed(dest): repo_db.set_hashes(conn, [(os.path.relpath(dest, local_repo_path), size, partial_hash, full_hash)])
+            import_log.write(os.path.relpath(dest, local_repo_path))
+            import_log.write('\n')
+            if not quiet: print('> {:<60}{:>13}'.format(os.path.relpath(dest, local_repo_path), 'imported'))
+    import_log.close()
+    conn.commit()
+    conn.close()
+    if verbose: print('Copying files into the local repo completed.')
 
     set_last_activity_time('import', 'local')
 
+    if skipped:
+        print("Skipped {} files already present in the repo.".format(skipped))
+    if deleted:
+        print("Deleted {} source files after verifying their content in the repo.".format(deleted))
+    if failed:
+        print("File import completed with {} failed files.".format(failed))
+        exit(1)
     print("File import completed successfully.")
 
-def cmd_cleanup(rating = 0):
-    trash_path = local_repo_path + '.trash'
-    os.makedirs(trash_path, exist_ok=True)
-    subprocess.call(['rsync', '--exclude=.trash', '--exclude=.pixync', '-a', '-f+ */', '-f- *' , local_repo_path, trash_path])
+def get_hash_row(file):
+    return (file, os.path.getsize(local_repo_path + file), file_util.get_partial_hash(local_repo_path + file), None)
+
+def cmd_rehash(jobs=IMPORT_JOBS):
+    repo_index = metadata_util.scan_repo(local_repo_path)
+    files = [file for file in repo_index['files'] if is_hashed(file)]
+
+    if verbose: print('Hashing {} files in the local repo.'.format(len(files)))
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        rows = list(executor.map(get_hash_row, files))
+
+    conn = repo_db.connect(local_repo_path)
+    repo_db.clear_hashes(conn)
+    repo_db.set_hashes(conn, rows)
+    conn.commit()
+    conn.close()
+
+    print("Hash index rebuilt for {} files.".format(len(rows)))
+
+def get_cleanup_plan(rating, jobs):
+    repo_index = metadata_util.scan_repo(local_repo_path)
+    rated_files = metadata_util.get_rated_files(repo_index, config_settings_global.get('embedded-ratings', False))
+
+    plan = set()
+    for metadata_file, r in metadata_util.get_ratings(local_repo_path, rated_files, jobs):
+        if r is not None and r < rating:
+            plan.update(metadata_util.get_related_files(repo_index, metadata_file))
+    return sorted(plan)
+
+def move_files(files, source_path, target_path):
+    for dir_path in set(os.path.dirname(file) for file in files):
+        os.makedirs(target_path + dir_path, exist_ok=True)
+    for file in files:
+        os.rename(source_path + file, target_path + file)
+
+def cmd_cleanup(rating = 0, jobs = 1):
+    trash_path = local_repo_path + '.trash' + os.path.sep
 
-    deleted_log = open(local_repo_path + appConfig.delete_log_path,'a+')
     if verbose: print("Reading the ratings")
-    for metadata_file in metadata_util.get_metadata_files(local_repo_path):
-        if verbose: print(metadata_file,'\t', end=' ')
-        r = metadata_util.get_rating(metadata_file)
-        if verbose: print(" [{}]".format(r))
-        if r < rating:
-            for file_to_delete in metadata_util.get_related_files(metadata_file, local_repo_path):
-                deleted_log.write(file_to_delete)
-                deleted_log.write('\n')
-                os.rename(file_to_delete, trash_path + os.path.sep + file_to_delete)
-    deleted_log.close()
-
-def cmd_upload(remote_repo_name, rating, service):
+    plan = get_cleanup_plan(rating, jobs)
+    if not plan:
+        print("Nothing to clean up.")
+        return
+
+    # the plan and the tombstones are recorded before any file is moved
+    run = int(time.time())
+    conn = repo_db.connect(local_repo_path)
+    repo_db.add_cleanup_plan(conn, run, plan)
+    repo_db.add_tombstones(conn, plan, run)
+    conn.commit()
+    conn.close()
+
+    move_files(plan, local_repo_path, trash_path)
+    print("{} files rated below {} moved to '{}'.".format(len(plan), rating, trash_path))
+
+def cmd_cleanup_restore():
+    trash_path = local_repo_path + '.trash' + os.path.sep
+
+    conn = repo_db.connect(local_repo_path)
+    run, plan = repo_db.get_last_cleanup_plan(conn)
+    if run is None:
+        print("No cleanup to restore.")
+        conn.close()
+        exit(1)
+
+    restored = [file for file in plan if os.path.lexists(trash_path + file) and not os.path.lexists(local_repo_path + file)]
+    move_files(restored, trash_path, local_repo_path)
+    repo_db.remove_tombstones(conn, restored)
+    repo_db.remove_cleanup_plan(conn, run)
+    conn.commit()
+    conn.close()
+
+    if len(restored) < len(plan): print("{} files were missing from '{}' or already present.".format(len(plan) - len(restored), trash_path))
+    print("{} files restored from '{}'.".format(len(restored), trash_path))
+
+def cmd_upload(remote_repo_name, rating, service, jobs=1, parallel=gdrive_adapter.TRANSFER_WORKERS):
 
     repos = get_remote_repos(True)
     repo = get_repo(repos, remote_repo_name)
@@ -519,8 +788,11 @@ def cmd_upload(remote_repo_name, rating, service):
     gdrive_adapter.local_repo_path = local_repo_path
     gdrive_adapter.verbose = verbose
     gdrive_adapter.quiet = quiet
+    gdrive_adapter.jobs = jobs
+    gdrive_adapter.workers = parallel
     gdrive_adapter.gdrive_repo_url = repo['url'][len(GDRIVE_REPO_PREFIX):].rstrip('/').split('/', 1)
     gdrive_adapter.set_config(config_settings_global)
+    gdrive_adapter.set_transfer_config(repo)
     gdrive_adapter.set_service_credentials(access_token) if service else gdrive_adapter.set_client_credentials(access_token)
     gdrive_adapter.upload_to_gdrive(rating)
 
@@ -615,30 +887,41 @@ pull_parser.add_argument('remote_repo_name', metavar='remote-repo-name', help='r
 pull_parser.add_argument('--delete', dest='delete', action='store_true')
 pull_parser.add_argument('--dry-run', dest='dry_run', action='store_true')
 pull_parser.add_argument('-r', '--rating', dest='rating', help='rating', type=int)
+pull_parser.add_argument('--parallel', dest='parallel', help='number of concurrent rsync workers', default=1, type=int)
 
 # push
 push_parser = func_parser.add_parser('push', parents=[common_parser], add_help=False)
-push_parser.add_argument('remote_repo_name', metavar='remote-repo-name', help='remote repository name')
+push_parser.add_argument('remote_repo_names', metavar='remote-repo-name', help='remote repository name', nargs='*')
+push_parser.add_argument('--all', dest='all_remotes', help='push to all remote repositories', action='store_true')
 push_parser.add_argument('--delete', dest='delete', action='store_true')
 push_parser.add_argument('--forced-delete', dest='forced_delete', action='store_true')
 push_parser.add_argument('--dry-run', dest='dry_run', action='store_true')
 push_parser.add_argument('-r', '--rating', dest='rating', help='rating', type=int)
+push_parser.add_argument('-j', '--jobs', dest='jobs', help='number of rating worker processes', default=1, type=int)
+push_parser.add_argument('--parallel', dest='parallel', help='number of concurrent rsync workers or GDrive uploads', type=int)
+push_parser.add_argument('--full', dest='full', help='ignore the change journal and compare the whole tree', action='store_true')
 
 # import
 import_parser = func_parser.add_parser('import', parents=[common_parser], add_help=False)
-import_parser.add_argument('media_source_path', metavar='media-source-path', help='media path')
-import_parser.add_argument('-c', '--camera-name', dest='cam_name', help='camera id', required=True)
+import_parser.add_argument('media_source_path', metavar='media-source-path', help='media path', nargs='?')
+import_parser.add_argument('-c', '--camera-name', dest='cam_name', help='camera id')
+import_parser.add_argument('--rehash', dest='rehash', help='rebuild the content hash index', action='store_true')
 import_parser.add_argument('--delete-source-files', dest='delete_source_files', action='store_true')
+import_parser.add_argument('-j', '--jobs', dest='jobs', help='number of concurrent file copies', default=IMPORT_JOBS, type=int)
 
 # cleanup
 cleanup_parser = func_parser.add_parser('cleanup', parents=[common_parser], add_help=False)
 cleanup_parser.add_argument('-r', '--rating', dest='rating', help='rating', default=0, type=int)
+cleanup_parser.add_argument('-j', '--jobs', dest='jobs', help='number of rating worker processes', default=1, type=int)
+cleanup_parser.add_argument('--restore', dest='restore', help='move the files of the last cleanup back from the trash', action='store_true')
 
 # upload
 upload_parser = func_parser.add_parser('upload', parents=[common_parser], add_help=False)
 upload_parser.add_argument('remote_repo_name', metavar='remote-repo-name', help='remote repository name')
 upload_parser.add_argument('-r', '--rating', dest='rating', help='rating', default=5, type=int)
 upload_parser.add_argument('-s', '--service', dest='service', help='run as service', action='store_true')
+upload_parser.add_argument('-j', '--jobs', dest='jobs', help='number of rating worker processes', default=1, type=int)
+upload_parser.add_argument('--parallel', dest='parallel', help='number of concurrent uploads', default=gdrive_adapter.TRANSFER_WORKERS, type=int)
 
 # remote
 remote_parser = func_parser.add_parser('remote', parents=[common_parser], add_help=False)
@@ -686,11 +969,16 @@ read_config()
 
 if args.func == 'init': cmd_init()
 elif args.func == 'clone': cmd_clone(args.remote_repo_url, args.remote_repo_name)
-elif args.func == 'pull': cmd_pull(args.remote_repo_name, args.delete, args.dry_run, args.rating)
-elif args.func == 'push': cmd_push(args.remote_repo_name, args.delete, args.forced_delete, args.dry_run, args.rating)
-elif args.func == 'import': cmd_import(args.media_source_path, args.cam_name, args.delete_source_files)
-elif args.func == 'cleanup': cmd_cleanup(args.rating)
-elif args.func == 'upload': cmd_upload(args.remote_repo_name, args.rating, args.service)
+elif args.func == 'pull': cmd_pull(args.remote_repo_name, args.delete, args.dry_run, args.rating, args.parallel)
+elif args.func == 'push': cmd_push(args.remote_repo_names, args.all_remotes, args.delete, args.forced_delete, args.dry_run, args.rating, args.jobs, args.parallel, args.full)
+elif args.func == 'import':
+    if args.rehash: cmd_rehash(args.jobs)
+    if args.media_source_path: cmd_import(args.media_source_path, args.cam_name, args.delete_source_files, args.jobs)
+    elif not args.rehash: import_parser.print_help()
+elif args.func == 'cleanup':
+    if args.restore: cmd_cleanup_restore()
+    else: cmd_cleanup(args.rating, args.jobs)
+elif args.func == 'upload': cmd_upload(args.remote_repo_name, args.rating, args.service, args.jobs, args.parallel)
 elif args.func == 'move': cmd_move(args.source, args.target)
 elif args.func == 'remote':
     if args.remote_func == 'ls': cmd_remote_ls(args.remote_ls_l)
@@ -0,0 +1,103 @@
+import os
+import shutil
+import hashlib
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+TEMP_SUFFIX = '.part'
+PARTIAL_HASH_SIZE = 64 * 1024
+JOURNAL_EXCLUDE_DIRS = ('.pixync', '.trash')
+
+def copy_file_data(src, dst, size):
+    copied = 0
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                count = os.copy_file_range(src.fileno(), dst.fileno(), min(COPY_CHUNK_SIZE, size - copied), copied, copied)
+                if count == 0: break
+                copied += count
+        except OSError:
+            pass
+
+    if copied < size and hasattr(os, 'sendfile'):
+        dst.seek(copied)
+        try:
+            while copied < size:
+                count = os.sendfile(dst.fileno(), src.fileno(), copied, min(COPY_CHUNK_SIZE, size - copied))
+                if count == 0: break
+                copied += count
+        except OSError:
+            pass
+
+    if copied < size:
+        src.seek(copied)
+        dst.seek(copied)
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+
+def copy_file(src_path, dst_path, sync=False):
+    temp_path = dst_path + TEMP_SUFFIX
+    try:
+        with open(src_path, 'rb') as src, open(temp_path, 'wb') as dst:
+            copy_file_data(src, dst, os.fstat(src.fileno()).st_size)
+            dst.flush()
+            if sync: os.fsync(dst.fileno())
+        shutil.copystat(src_path, temp_path)
+        os.replace(temp_path, dst_path)
+    except BaseException:
+        if os.path.exists(temp_path): os.remove(temp_path)
+        raise
+
+def is_same_file(src_path, dst_path):
+    if not os.path.exists(dst_path):
+        return False
+    src_stat = os.stat(src_path)
+    dst_stat = os.stat(dst_path)
+    return src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+def get_partial_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        digest.update(str(size).encode())
+        digest.update(file.read(PARTIAL_HASH_SIZE))
+        if size > 2 * PARTIAL_HASH_SIZE:
+            file.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+            digest.update(file.read(PARTIAL_HASH_SIZE))
+    return digest.hexdigest()
+
+def get_full_hash(path):
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(COPY_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(COPY_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_dir_digests(root_path, dir_path='', digests=None):
+    # every directory digest rolls up its own entries and the digests of its subdirectories
+    if digests is None: digests = {}
+
+    entries = []
+    with os.scandir(root_path + dir_path) as it:
+        for entry in it:
+            if dir_path == '' and entry.name in JOURNAL_EXCLUDE_DIRS: continue
+            if entry.is_dir(follow_symlinks=False):
+                child_path = os.path.join(dir_path, entry.name)
+                get_dir_digests(root_path, child_path, digests)
+                entries.append('d:{}:{}'.format(entry.name, digests[child_path][1]))
+            else:
+                stat = entry.stat(follow_symlinks=False)
+                entries.append('f:{}:{}:{}'.format(entry.name, stat.st_size, stat.st_mtime_ns))
+
+    entries.sort()
+    mtime = os.stat(root_path + dir_path).st_mtime_ns
+    entries.append(str(mtime))
+    digest = hashlib.blake2b('\n'.join(entries).encode('utf-8', 'surrogateescape'), digest_size=16).hexdigest()
+    digests[dir_path] = (mtime, digest)
+    return digests
@@ -4,7 +4,15 @@
 from __future__ import print_function
 from http.client import responses
 import io
+import json
+import hashlib
+import zipfile
 import os.path
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 from posixpath import relpath
 from google.oauth2 import credentials
 from googleapiclient.discovery import build
@@ -12,10 +20,15 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google.oauth2 import service_account
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload, MediaIoBaseUpload
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
+from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 import sys, glob, yaml
 import xml.etree.ElementTree as ET
 import metadata_util
+import file_util
+import repo_db
 
 # If modifying these scopes, delete the file token.json.
 GOOGLE_API_SCOPES = ['https://www.googleapis.com/auth/drive']
@@ -23,14 +36,52 @@ GOOGLE_API_CLIENT_CRED_FILE = "gcp-client-secret.json"
 GOOGLE_API_SERVICE_CRED_FILE = "gcp-service-key.json"
 SCRIPT_DIR_PATH = os.path.dirname(os.path.realpath(__file__)) + os.path.sep
 TOKEN_FILE = ".pixync" + os.path.sep + "gcp-security-token.json"
+IGNORE_FILE = ".pixignore"
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+LIST_PAGE_SIZE = 1000
+LIST_PARENTS_PER_QUERY = 40
+BATCH_SIZE = 100
+ITEM_FIELDS = "id, name, mimeType, parents, size, md5Checksum, modifiedTime"
+LIST_FIELDS = "nextPageToken, files({})".format(ITEM_FIELDS)
+TRANSFER_WORKERS = 4
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE_MB = 32
+UPLOAD_CHUNK_ALIGNMENT = 256 * 1024
+MULTIPART_THRESHOLD_MB = 5
+SESSION_MAX_AGE = 6 * 24 * 3600
+BUNDLE_NAME = '.sidecars.zip'
+BUNDLE_INDEX = 'index.json'
+ZIP_EPOCH = 315532800
+RETRY_LIMIT = 8
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 64
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_REASONS = (b'rateLimitExceeded', b'userRateLimitExceeded')
+CHANGE_FIELDS = "nextPageToken, newStartPageToken, changes(fileId, removed, file({}, trashed))".format(ITEM_FIELDS)
 verbose = False
 quiet = False
+jobs = 1
+workers = TRANSFER_WORKERS
+chunk_size = UPLOAD_CHUNK_SIZE_MB * 1024 * 1024
+multipart_threshold = MULTIPART_THRESHOLD_MB * 1024 * 1024
+bundle_sidecars = False
 path_mappings_repo_root = {}
-path_mappings_repo_sub_dir = {}
+tree_root = None
 
 local_repo_path = None
+repo_index = None
+changed_dirs = None
 gdrive_repo_url = None
 gdrive_tree = []
+tree_token = None
+# nodes added or changed since the cache was read, and nodes that left the tree with their subtree
+dirty_nodes = {}
+removed_nodes = {}
+tree_rebuilt = False
+tree_lock = threading.Lock()
+thread_state = threading.local()
+progress_lock = threading.Lock()
+progress = {}
 
 def print_step_header(title):
     if verbose: print("{:=^75}".format(title.upper()))
@@ -38,20 +89,41 @@ def print_step_header(title):
 def print_step_footer():
     if verbose: print("{:=^75}".format(''))
 
+def escape_query(value):
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+def list_files(q, fields=LIST_FIELDS):
+    files = []
+    page_token = None
+    while True:
+        response = call_with_backoff(gdrive_service.files().list(q=q, spaces='drive', pageSize=LIST_PAGE_SIZE,
+            pageToken=page_token, fields=fields).execute)
+        files.extend(response.get('files', []))
+        page_token = response.get('nextPageToken')
+        if page_token is None:
+            return files
+
+def list_children(parent_ids, q=None):
+    # several parents share one query, so a tree level costs a handful of paged calls
+    children = []
+    for start in range(0, len(parent_ids), LIST_PARENTS_PER_QUERY):
+        parents = ' or '.join("'{}' in parents".format(id) for id in parent_ids[start:start + LIST_PARENTS_PER_QUERY])
+        children.extend(list_files("({}) and trashed = false{}".format(parents, ' and ' + q if q else '')))
+    return children
+
 def get_dir(name, parent):
-    candidates = gdrive_service.files().list(q="name='{}' and mimeType = 'application/vnd.google-apps.folder' and parents in '{}'".format(name, parent.get('id')), 
-        spaces='drive', fields="nextPageToken, files(id, name)").execute()
-    items = candidates.get('files', [])
+    items = list_files("name = '{}' and mimeType = '{}' and '{}' in parents and trashed = false".format(escape_query(name), FOLDER_MIME_TYPE, parent.get('id')))
 
     if len is None or len(items) == 0: 
 
         file_metadata = {
             'name': name,
-            'mimeType': 'application/vnd.google-apps.folder',
+            'mimeType': FOLDER_MIME_TYPE,
             'parents': [parent.get('id')]
             }
-        return gdrive_service.files().create(body=file_metadata,
-                                    fields='id, name').execute()
+        dir = gdrive_service.files().create(body=file_metadata,
+                                    fields=ITEM_FIELDS).execute()
+        return dir
     else:
         dir = items[0]
 
@@ -59,62 +131,97 @@ def get_dir(name, parent):
         return dir
 
 def get_dir_for_path(path, parent, path_mappings):
-    for key in path_mappings:
-        if key == path:
-            return path_mappings[key]
-    
     path = os.path.normpath(path)
+    if path == '.':
+        return parent
+    if path in path_mappings:
+        return path_mappings[path]
 
     dir = parent
+    dir_path = ''
     for dir_comp in path.split(os.path.sep):
-        dir = get_dir(dir_comp, dir)
+        dir_path = os.path.join(dir_path, dir_comp)
+        if dir_path not in path_mappings:
+            path_mappings[dir_path] = get_dir(dir_comp, dir)
+        dir = path_mappings[dir_path]
 
-    path_mappings[path] = dir
     return dir
 
-def get_available_file(file):
-    dir_path, file_name = os.path.split(file)
-
-    if dir_path in path_mappings_repo_sub_dir:
-        dir = path_mappings_repo_sub_dir[dir_path]
-        if 'files' in dir:
-            for f in dir['files']:
-                if f['name'] == file_name:
-                    return f
+def get_node(path):
+    node = tree_root
+    path = os.path.normpath(path)
+    if path == '.':
+        return node
+    for name in path.split(os.path.sep):
+        if not node.children:
             return None
+        node = node.children.get(name)
+        if node is None:
+            return None
+    return node
+
+def get_available_file(file):
+    node = get_node(file)
+    if node is None or node.children is not None:
         return None
-    else:
-        return None
+    return node
+
+def get_md5_hex(node):
+    return node.md5.hex() if node.md5 is not None else None
+
+def get_local_md5s(files):
+    # hashes are cached by path, mtime and size, so unchanged files are read only once
+    conn = repo_db.connect(local_repo_path)
+    cache = repo_db.get_md5_cache(conn, files)
+
+    md5s = {}
+    rows = []
+    for file in files:
+        stat = os.stat(local_repo_path + file)
+        cached = cache.get(file)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            md5s[file] = cached[2]
+        else:
+            md5s[file] = file_util.get_md5(local_repo_path + file)
+            rows.append((file, stat.st_mtime_ns, stat.st_size, md5s[file]))
+
+    repo_db.set_md5s(conn, rows)
+    conn.commit()
+    conn.close()
+    return md5s
+
+def get_changed_files(files, get_remote_item):
+    # files differing in size need no hashing, same sized ones are compared by md5Checksum
+    changed = []
+    same_size = []
+    for file in files:
+        node = get_remote_item(file)
+        if os.path.getsize(local_repo_path + file) != node.size:
+            changed.append(file)
+        elif node.md5 is not None:
+            same_size.append(file)
+
+    md5s = get_local_md5s(same_size)
+    changed.extend(file for file in same_size if md5s[file] != get_md5_hex(get_remote_item(file)))
+    return set(changed)
+
+def to_rfc3339(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+def from_rfc3339(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
 
 def get_mime_type_by_ext(ext_mappings, ext):
     for k, v in ext_mappings.items():
         if k.lower() == ext.lower()[1:]: return v
     return 'application/octet-stream'
 
-def get_local_files_with_ignored_ratings():
-    files = []
-
-    ignore_ratings = 'ignore-ratings'
-    if not ignore_ratings in settings:
-        return files
-
-    for pattern in settings[ignore_ratings]:
-        filter = local_repo_path + "/**/" + pattern
-        for file in glob.iglob(filter, recursive=True):
-            files.append(os.path.relpath(file, local_repo_path))
-
-    return files
-
 def get_local_files(local_repo_path, rating):
-    files = []
-    for file in metadata_util.get_metadata_files(local_repo_path):
-        r = metadata_util.get_rating(file)
-        if r >= rating:
-            files.extend(metadata_util.get_related_files(file, local_repo_path))
-
-    files.extend(get_local_files_with_ignored_ratings())
-
-    return files
+    local_index = repo_index
+    if local_index is None:
+        local_index = metadata_util.scan_repo(local_repo_path,
+            metadata_util.read_patterns(local_repo_path + IGNORE_FILE), settings.get('ignore-ratings', []))
+    return metadata_util.get_files_by_rating(local_repo_path, local_index, rating, settings.get('embedded-ratings', False), jobs)
 
 def set_client_credentials(client_cred_file):
     global creds
@@ -150,65 +257,672 @@ def set_config(config):
     global settings
     settings = config
 
-def get_children_gdrive(parent, parent_path):
-    print("> {}".format(parent_path if len(parent_path)>0 else '<root>'))
-    if len(parent_path) > 0 and not os.path.exists(local_repo_path + os.path.sep + parent_path):
-        os.makedirs(local_repo_path + os.path.sep + parent_path)
-
-    children_response = gdrive_service.files().list(
-        q="parents in '{}'".format(parent.get('id')), 
-        spaces='drive', fields="nextPageToken, files(id, name, mimeType)").execute()
-    children = children_response.get('files',[])
-    for child in children:
-        child_path = parent_path + os.path.sep + child['name'] if len(parent_path) > 0 else child['name']
-        path_mappings_repo_sub_dir[child_path] = child
-        if child['mimeType'] == 'application/vnd.google-apps.folder':
-            get_children_gdrive(child, child_path)
+def set_transfer_config(repo):
+    global chunk_size, multipart_threshold, bundle_sidecars
+    bundle_sidecars = repo.get('sidecar-bundles', False)
+    # resumable uploads only take chunks in multiples of 256 KiB, so a fractional size is rounded to the nearest one
+    chunk_size = max(1, round(repo.get('chunk-size', UPLOAD_CHUNK_SIZE_MB) * 1024 * 1024 / UPLOAD_CHUNK_ALIGNMENT)) * UPLOAD_CHUNK_ALIGNMENT
+    multipart_threshold = int(repo.get('multipart-threshold', MULTIPART_THRESHOLD_MB) * 1024 * 1024)
+
+class RemoteNode:
+    # the remote tree can run to hundreds of thousands of items, so each one is kept as small as it gets:
+    # interned names, parent references instead of paths, binary checksums and numeric times
+    __slots__ = ('id', 'name', 'parent', 'mime_type', 'size', 'md5', 'modified', 'children')
+
+    def __init__(self, id, name, parent, mime_type, size=None, md5=None, modified=None):
+        self.id = id
+        self.name = sys.intern(name)
+        self.parent = parent
+        self.mime_type = sys.intern(mime_type)
+        self.size = int(size) if size is not None else None
+        self.md5 = bytes.fromhex(md5) if md5 is not None else None
+        self.modified = from_rfc3339(modified) if modified is not None else None
+        self.children = {} if mime_type == FOLDER_MIME_TYPE else None
+
+def make_node(item, parent):
+    return RemoteNode(item['id'], item['name'], parent, item['mimeType'], item.get('size'), item.get('md5Checksum'), item.get('modifiedTime'))
+
+def add_node(parent, item):
+    node = make_node(item, parent)
+    old = parent.children.get(node.name)
+    if old is not None and old.id != node.id:
+        removed_nodes[old.id] = old
+    parent.children[node.name] = node
+    dirty_nodes[node.id] = node
+    return node
+
+def link_node(items, node):
+    # freshly loaded nodes hold the id of their parent until it is known to be in the tree
+    parent = items.get(node.parent)
+    node.parent = parent
+    if parent is not None and parent.children is not None:
+        parent.children[node.name] = node
+
+def unlink_node(node):
+    parent = node.parent
+    if isinstance(parent, RemoteNode) and parent.children.get(node.name) is node:
+        del parent.children[node.name]
+    node.parent = None
+
+def replace_node(items, node):
+    old = items.get(node.id)
+    if old is not None:
+        unlink_node(old)
+        # a renamed or moved folder keeps its content
+        if old.children and node.children is not None:
+            node.children = old.children
+            for child in node.children.values():
+                child.parent = node
+    items[node.id] = node
+
+def is_in_tree(node):
+    # a node read from the feed holds the id of its parent until it is linked
+    while isinstance(node, RemoteNode):
+        if node is tree_root:
+            return True
+        node = node.parent
+    return False
+
+def walk_tree():
+    level = [('', tree_root)]
+    while level:
+        next_level = []
+        for parent_path, parent in level:
+            for name, child in parent.children.items():
+                child_path = os.path.join(parent_path, name)
+                yield child_path, child
+                if child.children is not None:
+                    next_level.append((child_path, child))
+        level = next_level
+
+def get_subtree_ids(node):
+    ids = []
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        ids.append(node.id)
+        if node.children:
+            nodes.extend(node.children.values())
+    return ids
+
+def is_tree_dirty():
+    return tree_rebuilt or bool(dirty_nodes) or bool(removed_nodes)
+
+def get_item_row(node):
+    return (node.id, node.name, node.parent.id, node.mime_type, str(node.size) if node.size is not None else None,
+        get_md5_hex(node), to_rfc3339(node.modified) if node.modified is not None else None)
+
+def reset_tree():
+    global tree_root
+    dirty_nodes.clear()
+    removed_nodes.clear()
+    tree_root = RemoteNode(gdrive_repo_root['id'], gdrive_repo_root.get('name', ''), None, FOLDER_MIME_TYPE)
+    return {tree_root.id: tree_root}
+
+def load_subtree(items, folder_ids):
+    # the tree is walked level by level, so the calls scale with its depth rather than its folder count
+    level = list(folder_ids)
+    while level:
+        next_level = []
+        for child in list_children(level):
+            parent = items[child['parents'][0]]
+            node = make_node(child, parent)
+            replace_node(items, node)
+            parent.children[node.name] = node
+            dirty_nodes[node.id] = node
+            if node.children is not None:
+                next_level.append(node.id)
+        level = next_level
+
+def get_repo_key():
+    return '/'.join(gdrive_repo_url)
+
+def read_tree_cache():
+    conn = repo_db.connect(local_repo_path)
+    state = repo_db.get_gdrive_state(conn, get_repo_key())
+    items = reset_tree()
+    for row in repo_db.get_gdrive_items(conn, get_repo_key()) if state else []:
+        node = RemoteNode(*row)
+        items[node.id] = node
+    conn.close()
+
+    for node in items.values():
+        link_node(items, node)
+    return state, items
+
+def write_tree_cache():
+    conn = repo_db.connect(local_repo_path)
+    repo_db.set_gdrive_state(conn, get_repo_key(), gdrive_repo_root['id'], tree_token)
+    if tree_rebuilt:
+        repo_db.set_gdrive_items(conn, get_repo_key(), [get_item_row(node) for path, node in walk_tree()])
+    else:
+        # only the rows of the nodes touched since the cache was read are written
+        removed_ids = [id for node in removed_nodes.values() for id in get_subtree_ids(node)]
+        removed_ids.extend(id for node in dirty_nodes.values() if not is_in_tree(node) for id in get_subtree_ids(node))
+        repo_db.remove_gdrive_items(conn, get_repo_key(), removed_ids)
+        repo_db.update_gdrive_items(conn, get_repo_key(), [get_item_row(node) for node in dirty_nodes.values() if is_in_tree(node)])
+    conn.commit()
+    conn.close()
+
+def apply_changes(items, page_token):
+    # returns None when the repo root itself is gone and the cache has to be rebuilt
+    new_folders = []
+    pending = []
+    while True:
+        response = call_with_backoff(gdrive_service.changes().list(pageToken=page_token, spaces='drive', pageSize=LIST_PAGE_SIZE,
+            includeRemoved=True, fields=CHANGE_FIELDS).execute)
+        for change in response.get('changes', []):
+            file = change.get('file')
+            if change['fileId'] == tree_root.id:
+                if change.get('removed') or file is None or file.get('trashed'):
+                    return None
+                continue
+            # the feed covers the whole Drive, only items that were or end up in the repo tree touch the cache
+            old = items.get(change['fileId'])
+            if change.get('removed') or file is None or file.get('trashed'):
+                if old is not None:
+                    if is_in_tree(old): removed_nodes[old.id] = old
+                    unlink_node(items.pop(old.id))
+                continue
+
+            node = make_node(file, file.get('parents', [None])[0])
+            if node.children is not None and old is None:
+                new_folders.append(node.id)
+            if old is not None and is_in_tree(old):
+                dirty_nodes[node.id] = node
+            replace_node(items, node)
+            pending.append(node)
+
+        page_token = response.get('nextPageToken', page_token)
+        if 'newStartPageToken' in response:
+            pending = [node for node in pending if items.get(node.id) is node]
+            for node in pending:
+                link_node(items, node)
+            dirty_nodes.update((node.id, node) for node in pending if is_in_tree(node))
+            return response['newStartPageToken'], new_folders
+
+def rebuild_tree():
+    if verbose: print('building the GDrive tree cache')
+    token = call_with_backoff(gdrive_service.changes().getStartPageToken().execute)['startPageToken']
+    items = reset_tree()
+    load_subtree(items, [tree_root.id])
+    return token, items
+
+def refresh_tree():
+    global tree_token, tree_rebuilt
+
+    tree_rebuilt = False
+    state, items = read_tree_cache()
+    changes = None
+    if state is not None:
+        try:
+            changes = apply_changes(items, state[1])
+        except HttpError as e:
+            # a throttled or failing feed is not a reason to list the whole tree again
+            if is_retryable(e):
+                print('Error occurred while reading the GDrive changes.')
+                exit(1)
+            if verbose: print('the GDrive change token is no longer valid')
+
+    if changes is None:
+        if state is not None:
+            resolve_repo_root()
+        tree_token, items = rebuild_tree()
+        tree_rebuilt = True
+        return
+
+    tree_token, new_folders = changes
+
+    # folders moved into the tree arrive without their content
+    new_folders = [id for id in new_folders if id in items and is_in_tree(items[id])]
+    if new_folders:
+        load_subtree(items, new_folders)
+    if verbose: print('{} GDrive items cached, {}'.format(sum(1 for item in walk_tree()), 'updated' if is_tree_dirty() else 'unchanged'))
 
 def build_directory_tree_gdrive():
     print_step_header("building directory tree")
-    get_children_gdrive(gdrive_repo_root, '')
+    refresh_tree()
+
+    print("> <root>")
+    for path, node in walk_tree():
+        if node.children is not None:
+            print("> {}".format(path))
+            os.makedirs(local_repo_path + path, exist_ok=True)
+
     print_step_footer()
 
+def download_chunk(request, fh, offset, end):
+    resp, content = request.http.request(request.uri, headers={'range': 'bytes={}-{}'.format(offset, end - 1)})
+    if resp.status not in (200, 206):
+        raise HttpError(resp, content, uri=request.uri)
+    if resp.status == 200 and offset > 0:
+        # the range was ignored and the whole file came back
+        fh.seek(0)
+        fh.truncate()
+    fh.write(content)
+    return fh.tell()
+
+def download_file(item):
+    local_file_path = local_repo_path + item
+    temp_path = local_file_path + file_util.TEMP_SUFFIX
+    remote_item = get_node(item)
+    size = remote_item.size
+
+    # a .part file left by an interrupted run is resumed from where it stopped
+    offset = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+    if offset > size:
+        offset = 0
+    update_progress(sent=offset)
+
+    request = get_thread_service().files().get_media(fileId=remote_item.id)
+    with open(temp_path, 'ab' if offset else 'wb') as fh:
+        while offset < size:
+            position = call_with_backoff(lambda: download_chunk(request, fh, offset, min(offset + DOWNLOAD_CHUNK_SIZE, size)))
+            update_progress(sent=position - offset)
+            offset = position
+
+    if remote_item.md5 is not None and file_util.get_md5(temp_path) != get_md5_hex(remote_item):
+        os.remove(temp_path)
+        update_progress(item, 'corrupt', -size, True)
+        return False
+
+    if remote_item.modified is not None:
+        os.utime(temp_path, (remote_item.modified, remote_item.modified))
+    os.replace(temp_path, local_file_path)
+    update_progress(item, 'downloaded', completed=True)
+    return True
+
+def is_remote_newer(item):
+    # a shorter local copy is also taken for a truncated download
+    remote_item = get_node(item)
+    if os.path.getsize(local_repo_path + item) < remote_item.size:
+        return True
+    return remote_item.modified is not None and remote_item.modified > os.path.getmtime(local_repo_path + item)
+
+def download_items(items):
+    items = [item for item in items if get_node(item).size is not None]
+    local_items = [item for item in items if os.path.exists(local_repo_path + item)]
+    changed = get_changed_files(local_items, get_node)
+
+    downloads = [item for item in items if not os.path.exists(local_repo_path + item)]
+    for item in local_items:
+        if item not in changed:
+            if verbose: print ('> {:<60}{:>13}'.format(item, 'available'))
+        elif is_remote_newer(item):
+            downloads.append(item)
+        else:
+            print ('> {:<60}{:>13}'.format(item, 'local newer'))
+
+    if not downloads:
+        return
+
+    start_progress(len(downloads), sum(get_node(item).size for item in downloads))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        results = [future.result() for future in [executor.submit(download_file, item) for item in downloads]]
+
+    # the verified checksums go straight into the hash cache
+    conn = repo_db.connect(local_repo_path)
+    rows = []
+    for item, result in zip(downloads, results):
+        if result and get_node(item).md5 is not None:
+            stat = os.stat(local_repo_path + item)
+            rows.append((item, stat.st_mtime_ns, stat.st_size, get_md5_hex(get_node(item))))
+    repo_db.set_md5s(conn, rows)
+    conn.commit()
+    conn.close()
+
+    if not all(results):
+        print('{} files failed the checksum verification.'.format(results.count(False)))
+        exit(1)
+
+def get_rated_items(items, rating):
+    ignore_rating_patterns = settings.get('ignore-ratings', [])
+    repo_index = metadata_util.scan_repo(local_repo_path, metadata_util.read_patterns(local_repo_path + IGNORE_FILE))
+    rated_stems = metadata_util.get_rated_stems(local_repo_path, repo_index['metadata_files'], rating, jobs)
+    return [item for item in items if metadata_util.is_rated_file(item, rated_stems) or metadata_util.match_patterns(item, False, ignore_rating_patterns)]
+
 def download_files(rating):
     print_step_header("downloading files")
-    for item in path_mappings_repo_sub_dir:
-        local_file_path = local_repo_path + item
-        local_file_rel_path = os.path.relpath(local_file_path, local_repo_path)
-        if os.path.exists(local_file_path):
-            print ('> {:<60}{:>13}'.format(local_file_rel_path, 'available'))
-        else:
-            request = gdrive_service.files().get_media(fileId=path_mappings_repo_sub_dir[item]['id'])
-            fh = io.FileIO(item, 'wb')
-            downloader = MediaIoBaseDownload(fh, request, chunksize=1024*1024)
-            response = False
-            while response is False:
-                status, response = downloader.next_chunk()
-                if status: print ('> {:<60}{:>13}'.format(local_file_rel_path, '[{}%]'.format(int(status.progress() * 100))), end='\r')
-            print ('> {:<60}{:>13}'.format(local_file_rel_path,'downloaded'))
-            
+    items = [path for path, node in walk_tree() if node.children is None]
+
+    # sidecar bundles are unpacked first, whatever mode the remote is pushed in
+    bundles = [item for item in items if os.path.basename(item) == BUNDLE_NAME]
+    extract_bundles(bundles)
+    items = [item for item in items if os.path.basename(item) != BUNDLE_NAME]
+
+    if rating:
+        sidecars = set(item for item in items if os.path.splitext(item)[1].lower() in metadata_util.METADATA_EXTENSIONS)
+        download_items(sorted(sidecars))
+        items = [item for item in get_rated_items(items, rating) if item not in sidecars]
+
+    download_items(items)
+
     print_step_footer()
 
+def execute_batch(requests):
+    responses = [None] * len(requests)
+    errors = {}
+
+    def callback(request_id, response, exception):
+        if exception is None: responses[int(request_id)] = response
+        else: errors[int(request_id)] = exception
+
+    for start in range(0, len(requests), BATCH_SIZE):
+        batch = gdrive_service.new_batch_http_request(callback=callback)
+        for index in range(start, min(start + BATCH_SIZE, len(requests))):
+            batch.add(requests[index], request_id=str(index))
+        call_with_backoff(batch.execute)
+
+    # throttled parts of a batch are retried one by one
+    for index, error in sorted(errors.items()):
+        if not is_retryable(error): raise error
+        responses[index] = call_with_backoff(requests[index].execute)
+    return responses
+
+def get_parent_dir(dir_path):
+    return get_node(os.path.dirname(dir_path))
+
+def resolve_dirs(dir_paths):
+    levels = {}
+    for dir_path in dir_paths:
+        dir_comps = dir_path.split(os.path.sep)
+        for depth in range(1, len(dir_comps) + 1):
+            path = os.path.join(*dir_comps[:depth])
+            if get_node(path) is None: levels.setdefault(depth, set()).add(path)
+
+    # the tree cache already holds every folder under the repo root, so whatever is missing
+    # is created with one batch per tree level
+    for depth in sorted(levels):
+        creates = sorted(levels[depth])
+        responses = execute_batch([gdrive_service.files().create(
+            body={'name': os.path.basename(path), 'mimeType': FOLDER_MIME_TYPE, 'parents': [get_parent_dir(path).id]},
+            fields=ITEM_FIELDS) for path in creates])
+        for path, dir in zip(creates, responses):
+            add_node(get_parent_dir(path), dir)
+        if verbose: print('level {}: {} folders created'.format(depth, len(creates)))
+
+def get_dir_node(dir_path):
+    if get_node(dir_path) is None:
+        resolve_dirs([os.path.normpath(dir_path)])
+    return get_node(dir_path)
+
 def build_directory_tree_local():
     print_step_header('building directory tree')
+    refresh_tree()
 
-    dir_tree = glob.glob(local_repo_path +'/**/', recursive=True)
-    for dir_path in dir_tree:
-        if dir_path == local_repo_path: continue
+    dir_paths = []
+    for dir_path in glob.glob(local_repo_path +'/**/', recursive=True):
         gdrive_dir_path = os.path.relpath(dir_path, local_repo_path)
-        if verbose: print('>' , gdrive_dir_path)
-        dir = get_dir_for_path( gdrive_dir_path , gdrive_repo_root, path_mappings_repo_sub_dir)
+        if gdrive_dir_path == '.': continue
+        if changed_dirs is not None and gdrive_dir_path not in changed_dirs: continue
+        dir_paths.append(gdrive_dir_path)
+
+    resolve_dirs(dir_paths)
+    if verbose:
+        for dir_path in sorted(dir_paths):
+            print('> {:<60}{:>13}'.format(dir_path, '{} files'.format(sum(1 for node in get_node(dir_path).children.values() if node.children is None))))
+    print_step_footer()
+
+def get_thread_service():
+    # httplib2 is not thread safe, every worker thread holds its own client
+    if not hasattr(thread_state, 'service'):
+        thread_state.service = build('drive', 'v3', http=AuthorizedHttp(creds, http=httplib2.Http()), cache_discovery=False)
+    return thread_state.service
+
+def is_retryable(error):
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        return status in RETRY_STATUSES or (status == 403 and any(reason in (error.content or b'') for reason in RETRY_REASONS))
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+def call_with_backoff(call):
+    # exponential backoff with full jitter, so throttled workers do not retry in lockstep
+    for attempt in range(RETRY_LIMIT):
+        try:
+            return call()
+        except (HttpError, ConnectionError, TimeoutError) as e:
+            if attempt == RETRY_LIMIT - 1 or not is_retryable(e):
+                raise
+            time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+
+def start_progress(total_files, total_bytes):
+    progress.update({'files': 0, 'bytes': 0, 'total_files': total_files, 'total_bytes': total_bytes or 1})
+
+def update_progress(file=None, status=None, sent=0, completed=False):
+    with progress_lock:
+        progress['bytes'] += sent
+        if completed: progress['files'] += 1
+        if quiet: return
+        if status: print('> {:<60}{:>13}'.format(file[-60:], status))
+        summary = '{} of {} files'.format(progress['files'], progress['total_files'])
+        print('> {:<60}{:>13}'.format(summary, '[{}%]'.format(int(progress['bytes'] * 100 / progress['total_bytes']))),
+            end='\r' if progress['files'] < progress['total_files'] else '\n')
+
+def read_upload_session(file, stat):
+    conn = repo_db.connect(local_repo_path)
+    session = repo_db.get_upload_session(conn, get_repo_key(), file)
+    conn.close()
+
+    # a session only applies to the exact file it was opened for, and Drive expires it after a week
+    if session is None:
+        return None
+    size, mtime, uri, offset, created = session
+    if size != stat.st_size or mtime != stat.st_mtime_ns or time.time() - created > SESSION_MAX_AGE:
+        write_upload_session(file)
+        return None
+    return uri, created
+
+def write_upload_session(file, stat=None, uri=None, offset=0, created=None):
+    conn = repo_db.connect(local_repo_path)
+    if uri is None:
+        repo_db.remove_upload_session(conn, get_repo_key(), file)
+    else:
+        repo_db.set_upload_session(conn, get_repo_key(), file, stat.st_size, stat.st_mtime_ns, uri, offset, created)
+    conn.commit()
+    conn.close()
+
+def get_committed_range(request, uri, size):
+    # an empty PUT with an open range asks Drive how much of the session it already holds
+    resp, content = request.http.request(uri, method='PUT', headers={'Content-Length': '0', 'Content-Range': 'bytes */{}'.format(size)})
+    if resp.status in (200, 201):
+        return size, json.loads(content)
+    if resp.status == 308:
+        committed = resp.get('range')
+        return (int(committed.rsplit('-', 1)[1]) + 1 if committed else 0), None
+    if resp.status in (404, 410):
+        return None, None
+    raise HttpError(resp, content, uri=uri)
+
+def resume_upload_session(file, stat, request):
+    session = read_upload_session(file, stat)
+    if session is None:
+        return None, None
+
+    uri, created = session
+    offset, response = call_with_backoff(lambda: get_committed_range(request, uri, stat.st_size))
+    if offset is None:
+        write_upload_session(file)
+        return None, None
+
+    if verbose: print('> {:<60}{:>13}'.format(file[-60:], 'resumed'))
+    request.resumable_uri = uri
+    request.resumable_progress = offset
+    return created, response
+
+def upload_file(file, dir, mime_type, remote_item=None):
+    # the remote copy carries the local mtime, which keeps pull's newer-than checks meaningful
+    file_metadata = {'modifiedTime': to_rfc3339(os.path.getmtime(local_repo_path + file))}
+    with io.FileIO(local_repo_path + file) as fh:
+        # small files go up in a single multipart request, large ones in big resumable chunks
+        resumable = os.fstat(fh.fileno()).st_size >= multipart_threshold
+        media = MediaIoBaseUpload(fh, mimetype=mime_type, chunksize=chunk_size, resumable=resumable)
+        if remote_item is None:
+            file_metadata.update({'name': os.path.basename(file), 'parents': [dir.id]})
+            request = get_thread_service().files().create(body=file_metadata,
+                    media_body=media,
+                    fields=ITEM_FIELDS)
+        else:
+            request = get_thread_service().files().update(fileId=remote_item.id, body=file_metadata,
+                    media_body=media,
+                    fields=ITEM_FIELDS)
+        sent = 0
+        if resumable:
+            stat = os.fstat(fh.fileno())
+            created, response = resume_upload_session(file, stat, request)
+            sent = stat.st_size if response else request.resumable_progress
+            update_progress(sent=sent)
+
+            # the session is recorded after every chunk, so a later run picks up from the last one
+            while response is None:
+                status, response = call_with_backoff(request.next_chunk)
+                if status:
+                    update_progress(sent=status.resumable_progress - sent)
+                    sent = status.resumable_progress
+                    created = created or int(time.time())
+                    write_upload_session(file, stat, request.resumable_uri, sent, created)
+            write_upload_session(file)
+        else:
+            response = call_with_backoff(request.execute)
+
+    update_progress(file, 'uploaded' if remote_item is None else 'updated', int(response.get('size', sent)) - sent, True)
+    add_remote_file(dir, response)
+
+def add_remote_file(dir, response):
+    # an updated file comes back under its old name and takes the place of the previous node
+    with tree_lock:
+        add_node(dir, response)
+
+def is_safe_member(name):
+    return name not in ('', '.', '..') and '/' not in name and '\\' not in name and os.path.sep not in name
+
+def read_bundle(data):
+    # members are written next to the bundle, a name reaching into another directory is never followed
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        index = json.loads(archive.read(BUNDLE_INDEX))
+        for name in [name for name in index if not is_safe_member(name)]:
+            print('> {:<60}{:>13}'.format(name[-60:], 'rejected'))
+            del index[name]
+        return index, {name: archive.read(name) for name in index}
+
+def write_bundle(index, members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(BUNDLE_INDEX, json.dumps(index, sort_keys=True))
+        for name in sorted(index):
+            date_time = time.localtime(max(index[name][1] / 1e9, ZIP_EPOCH))[:6]
+            archive.writestr(zipfile.ZipInfo(name, date_time), members[name], zipfile.ZIP_DEFLATED)
+    return buffer.getvalue()
+
+def download_bundle(item):
+    return call_with_backoff(get_thread_service().files().get_media(fileId=item.id).execute)
+
+def read_bundle_cache(dir_path):
+    conn = repo_db.connect(local_repo_path)
+    cached = repo_db.get_sidecar_bundle(conn, get_repo_key(), dir_path)
+    conn.close()
+    return cached
+
+def write_bundle_cache(dir_path, md5, index):
+    conn = repo_db.connect(local_repo_path)
+    repo_db.set_sidecar_bundle(conn, get_repo_key(), dir_path, md5, json.dumps(index, sort_keys=True))
+    conn.commit()
+    conn.close()
+
+def upload_bundle(dir_path, dir, sidecars):
+    bundle_path = os.path.join(dir_path, BUNDLE_NAME)
+    remote_item = get_available_file(bundle_path)
+
+    local_index = {}
+    for file in sidecars:
+        stat = os.stat(local_repo_path + file)
+        local_index[os.path.basename(file)] = [stat.st_size, stat.st_mtime_ns]
+    size = sum(member[0] for member in local_index.values())
+
+    # the index of the last bundle sent or fetched saves downloading it again when nothing moved on the remote
+    remote_index = {}
+    members = None
+    if remote_item is not None:
+        cached = read_bundle_cache(dir_path)
+        if cached and cached[0] == get_md5_hex(remote_item):
+            remote_index = json.loads(cached[1])
+        else:
+            remote_index, members = read_bundle(download_bundle(remote_item))
+
+    if all(remote_index.get(name) == member for name, member in local_index.items()):
+        update_progress(bundle_path, 'available' if verbose else None, size, True)
+        return
+
+    # members only the remote holds are carried over, so bundles grow like plain uploads do
+    if members is None and any(name not in local_index for name in remote_index):
+        remote_index, members = read_bundle(download_bundle(remote_item))
+    index = dict(remote_index)
+    index.update(local_index)
+    contents = {name: members[name] for name in remote_index if name not in local_index}
+    for name in local_index:
+        with open(local_repo_path + os.path.join(dir_path, name), 'rb') as file:
+            contents[name] = file.read()
+
+    data = write_bundle(index, contents)
+    media = MediaIoBaseUpload(io.BytesIO(data), mimetype='application/zip', resumable=False)
+    file_metadata = {'modifiedTime': to_rfc3339(time.time())}
+    if remote_item is None:
+        file_metadata.update({'name': BUNDLE_NAME, 'parents': [dir.id]})
+        request = get_thread_service().files().create(body=file_metadata, media_body=media, fields=ITEM_FIELDS)
+    else:
+        request = get_thread_service().files().update(fileId=remote_item.id, body=file_metadata, media_body=media, fields=ITEM_FIELDS)
+    response = call_with_backoff(request.execute)
+
+    write_bundle_cache(dir_path, hashlib.md5(data).hexdigest(), index)
+    update_progress(bundle_path, '{} packed'.format(len(index)), size, True)
+    add_remote_file(dir, response)
+
+def is_stale_member(dir_path, name, size, mtime):
+    local_file_path = local_repo_path + os.path.join(dir_path, name)
+    if not os.path.exists(local_file_path):
+        return True
+    stat = os.stat(local_file_path)
+    if stat.st_size == size and stat.st_mtime_ns == mtime:
+        return False
+    if stat.st_mtime_ns > mtime:
+        if verbose: print ('> {:<60}{:>13}'.format(os.path.join(dir_path, name), 'local newer'))
+        return False
+    return True
+
+def extract_bundle(bundle_path):
+    dir_path = os.path.dirname(bundle_path)
+    remote_item = get_node(bundle_path)
+
+    # a bundle unchanged since the last sync is only fetched when one of its members is missing or outdated here
+    cached = read_bundle_cache(dir_path)
+    if cached and cached[0] == get_md5_hex(remote_item):
+        index, members = json.loads(cached[1]), None
+    else:
+        index, members = read_bundle(download_bundle(remote_item))
 
-        if not 'files' in dir:
-            files_response = gdrive_service.files().list(q="mimeType != 'application/vnd.google-apps.folder' and parents in '{}'".format(dir.get('id')), 
-            spaces='drive', fields="nextPageToken, files(id, name)").execute()
-            files_in_dir = files_response.get('files',[])
+    stale = [name for name, (size, mtime) in sorted(index.items()) if is_safe_member(name) and is_stale_member(dir_path, name, size, mtime)]
+    if stale and members is None:
+        index, members = read_bundle(download_bundle(remote_item))
+        stale = [name for name in stale if name in index]
 
-            if verbose: 
-                for file in files_in_dir: print(">> {}".format(file))
+    for name in stale:
+        local_file_path = local_repo_path + os.path.join(dir_path, name)
+        mtime = index[name][1]
+        with open(local_file_path + file_util.TEMP_SUFFIX, 'wb') as file:
+            file.write(members[name])
+        os.utime(local_file_path + file_util.TEMP_SUFFIX, ns=(mtime, mtime))
+        os.replace(local_file_path + file_util.TEMP_SUFFIX, local_file_path)
 
-            dir['files'] = files_in_dir
-    print_step_footer()
+    write_bundle_cache(dir_path, get_md5_hex(remote_item), index)
+    update_progress(bundle_path, '{} unpacked'.format(len(stale)), remote_item.size or 0, True)
+
+def extract_bundles(bundles):
+    if not bundles:
+        return
+
+    start_progress(len(bundles), sum(get_node(bundle).size or 0 for bundle in bundles))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for future in [executor.submit(extract_bundle, bundle) for bundle in bundles]:
+            future.result()
 
 def upload_files(rating):
     ext_mappings = {}
@@ -219,53 +933,82 @@ def upload_files(rating):
 
     print_step_header("uploading files")
     files_to_upload = get_local_files(local_repo_path, rating)
-
+    if changed_dirs is not None:
+        files_to_upload = [file for file in files_to_upload if os.path.dirname(file) in changed_dirs]
+
+    # in bundle mode the sidecars of a directory travel as one archive
+    bundles = {}
+    if bundle_sidecars:
+        for file in files_to_upload:
+            if os.path.splitext(file)[1].lower() in metadata_util.SIDECAR_EXTENSIONS:
+                bundles.setdefault(os.path.dirname(file), []).append(file)
+        bundled = set(file for sidecars in bundles.values() for file in sidecars)
+        files_to_upload = [file for file in files_to_upload if file not in bundled]
+
+    # folders are resolved up front on the main client, the workers only transfer file content
+    remote_files = [file for file in files_to_upload if get_available_file(file)]
+    changed = get_changed_files(remote_files, get_available_file)
+
+    uploads = []
     for file in files_to_upload:
         dir_path, file_name = os.path.split(file)
-        dir = get_dir_for_path(dir_path, gdrive_repo_root, path_mappings_repo_sub_dir)
+        dir = get_dir_node(dir_path)
+        remote_item = get_available_file(file)
 
-        if get_available_file(file):
-            print ('> {:<60}{:>13}'.format(file, 'available'))
+        if remote_item and file not in changed:
+            if verbose: print ('> {:<60}{:>13}'.format(file, 'available'))
         else:
-            file_extension = os.path.splitext(file_name)[1]
-            file_metadata = {
-                'name': file_name,
-                'parents': [dir.get('id')]
-                }
-            media = MediaIoBaseUpload(io.FileIO(local_repo_path + file),
-                mimetype=get_mime_type_by_ext(ext_mappings, file_extension), chunksize=1024*1024, resumable=True)
-            request = gdrive_service.files().create(body=file_metadata,
-                    media_body=media,
-                    fields='id, name')
-            response = None
-            while response is None:
-                status, response = request.next_chunk()
-                if status: print ('> {:<60}{:>13}'.format(file, '[{}%]'.format(int(status.progress() * 100))), end='\r')
-            dir['files'].append(response)
-            print ('> {:<60}{:>13}'.format(file,'uploaded'))
+            uploads.append((file, dir, get_mime_type_by_ext(ext_mappings, os.path.splitext(file_name)[1]), remote_item))
+
+    if verbose: print('{} of {} files to upload'.format(len(uploads), len(files_to_upload)))
+    if uploads or bundles:
+        start_progress(len(uploads) + len(bundles), sum(os.path.getsize(local_repo_path + file) for file in
+            [upload[0] for upload in uploads] + [file for sidecars in bundles.values() for file in sidecars]))
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = [executor.submit(upload_file, *upload) for upload in uploads]
+            for dir_path, sidecars in sorted(bundles.items()):
+                futures.append(executor.submit(upload_bundle, dir_path, get_dir_node(dir_path), sidecars))
+            for future in futures:
+                future.result()
 
     print_step_footer()
 
-def init_gdrive_service():
-    global gdrive_service, gdrive_pixync_root, gdrive_repo_path, gdrive_repo_root
-
-    root_dir_id, gdrive_repo_path = gdrive_repo_url
-    gdrive_service = build('drive', 'v3', credentials=creds)
+def resolve_repo_root():
+    global gdrive_pixync_root, gdrive_repo_root
 
     try:
-        gdrive_pixync_root = gdrive_service.files().get(fileId=root_dir_id).execute()
+        gdrive_pixync_root = gdrive_service.files().get(fileId=gdrive_repo_url[0]).execute()
+        path_mappings_repo_root.clear()
         gdrive_repo_root = get_dir_for_path(gdrive_repo_path, gdrive_pixync_root, path_mappings_repo_root)
 
     except:
         print('Error occurred while accessing the pixync root directory on GDrive.')
         exit(1)
 
+def init_gdrive_service():
+    global gdrive_service, gdrive_repo_path, gdrive_repo_root
+
+    root_dir_id, gdrive_repo_path = gdrive_repo_url
+    gdrive_service = build('drive', 'v3', credentials=creds)
+
+    # a cached tree also holds the repo root, so a no-op sync starts with the changes feed alone
+    conn = repo_db.connect(local_repo_path)
+    state = repo_db.get_gdrive_state(conn, get_repo_key())
+    conn.close()
+
+    if state is None:
+        resolve_repo_root()
+    else:
+        gdrive_repo_root = {'id': state[0], 'name': os.path.basename(gdrive_repo_path), 'mimeType': FOLDER_MIME_TYPE}
+
 def upload_to_gdrive(rating):
     init_gdrive_service()
     build_directory_tree_local()
     upload_files(rating)
+    write_tree_cache()
 
 def pull(rating):
     init_gdrive_service()
     build_directory_tree_gdrive()
+    write_tree_cache()
     download_files(rating)
\ No newline at end of file
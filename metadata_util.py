@@ -1,11 +1,29 @@
 import xml.etree.ElementTree as ET
-import os, glob
-from libxmp.utils import file_to_dict
-from libxmp import consts
+import os, re, struct
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+import repo_db
+
+try:
+    from libxmp.utils import file_to_dict
+except ImportError:
+    file_to_dict = None
 
 
 XMP_NS_RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
 XMP_NS_XAP = "http://ns.adobe.com/xap/1.0/"
+METADATA_EXTENSIONS = ('.xmp', '.pp3')
+SIDECAR_EXTENSIONS = ('.xmp', '.pp3', '.arp')
+EMBED_EXTENSIONS = ('.jpg', '.jpeg', '.dng', '.tif', '.tiff')
+DERIVATIVE_SEPARATORS = ('_', '-')
+XMP_APP1_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+TIFF_TAG_XMP = 700
+XMP_RATING_PATTERN = re.compile(rb'xmp:Rating\s*(?:=\s*["\']\s*(-?\d+)\s*["\']|>\s*(-?\d+)\s*<)')
+COMMIT_DIR = '.commit'
+READ_CHUNK_SIZE = 16 * 1024
+PARALLEL_MIN_FILES = 512
+PARALLEL_CHUNK_SIZE = 64
 
 def build_glob_pattern(mask_base, *extensions):
     mask_ext = ['[{}]'.format(''.join(set(c))) for c in zip(*extensions)]
@@ -16,37 +34,146 @@ def build_glob_pattern(mask_base, *extensions):
 def get_rating(metadata_file):
     ext = os.path.splitext(metadata_file)[1][1:]
     if ext in ('xmp', 'XMP'):
-        return get_rating_xmp(metadata_file)
+        rating = get_rating_xmp_stream(metadata_file)
+        if rating is None:
+            rating = get_rating_xmp(metadata_file)
+        return rating
     elif ext in ('pp3', 'PP3'):
         return get_rating_pp3(metadata_file)
+    elif '.' + ext.lower() in EMBED_EXTENSIONS:
+        return read_rating_embed(metadata_file)
     return 0
 
+def get_rating_xmp_stream(xmp_file):
+    # returns None when the rating may be bound to a prefix other than 'xmp:' and a full parse is required
+    has_rating = False
+    tail = b''
+    with open(xmp_file, 'rb') as file:
+        while True:
+            chunk = file.read(READ_CHUNK_SIZE)
+            if not chunk: break
+            buffer = tail + chunk
+            match = XMP_RATING_PATTERN.search(buffer)
+            if match:
+                return int(match.group(1) or match.group(2))
+            has_rating = has_rating or b'Rating' in buffer
+            tail = buffer[-64:]
+
+    return None if has_rating else 0
+
 def get_rating_xmp(xmp_file):
-    desc_with_rating = ET.parse(xmp_file).getroot().find("./{"+XMP_NS_RDF+"}RDF/{"+XMP_NS_RDF+"}Description/[@{"+XMP_NS_XAP+"}Rating]")
-    if desc_with_rating is None:
-        return 0
-    return int(desc_with_rating.get("{"+XMP_NS_XAP+"}Rating"))
+    root = ET.parse(xmp_file).getroot()
+    desc_with_rating = root.find("./{"+XMP_NS_RDF+"}RDF/{"+XMP_NS_RDF+"}Description/[@{"+XMP_NS_XAP+"}Rating]")
+    if desc_with_rating is not None:
+        return int(desc_with_rating.get("{"+XMP_NS_XAP+"}Rating"))
+
+    rating = root.find(".//{"+XMP_NS_XAP+"}Rating")
+    if rating is not None and rating.text:
+        return int(rating.text.strip())
+    return 0
 
 def get_rating_pp3(pp3_file):
+    rank = None
+    in_trash = None
     with open(pp3_file,'r') as file:
         for line in file:
-            if line.startswith("InTrash") and line.rstrip('\n').split('=')[1] == 'true':
-                return -1
+            if line.startswith("InTrash"):
+                in_trash = line.rstrip('\n').split('=')[1] == 'true'
+                if in_trash: return -1
+            elif line.startswith("Rank") and rank is None:
+                rank = int(line.rstrip('\n').split('=')[1])
 
-        file.seek(0)
-        for line in file:
-            if line.startswith("Rank"):
-                return int(line.rstrip('\n').split('=')[1])
+            if rank is not None and in_trash is not None: break
 
-    return 0
+    return rank if rank is not None else 0
+
+def get_rating_xmp_packet(packet):
+    match = XMP_RATING_PATTERN.search(packet)
+    if match:
+        return int(match.group(1) or match.group(2))
+    if b'Rating' not in packet:
+        return None
+
+    try:
+        root = ET.fromstring(packet.strip(b'\x00 \r\n\t'))
+    except ET.ParseError:
+        return None
+    rating = root.find(".//*[@{"+XMP_NS_XAP+"}Rating]")
+    if rating is not None:
+        return int(rating.get("{"+XMP_NS_XAP+"}Rating"))
+    rating = root.find(".//{"+XMP_NS_XAP+"}Rating")
+    if rating is not None and rating.text:
+        return int(rating.text.strip())
+    return None
+
+def read_xmp_packet_jpeg(file):
+    file.seek(2)
+    while True:
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return b''
+        while marker[1] == 0xFF:
+            marker = b'\xff' + file.read(1)
+            if len(marker) < 2:
+                return b''
+        if marker[1] in (0xD9, 0xDA):
+            return b''
+        if 0xD0 <= marker[1] <= 0xD7 or marker[1] == 0x01:
+            continue
+
+        length = struct.unpack('>H', file.read(2))[0] - 2
+        if marker[1] == 0xE1 and length > len(XMP_APP1_HEADER):
+            header = file.read(len(XMP_APP1_HEADER))
+            if header == XMP_APP1_HEADER:
+                return file.read(length - len(header))
+            length -= len(header)
+        file.seek(length, os.SEEK_CUR)
+
+def read_xmp_packet_tiff(file, byte_order):
+    ifd_offset = struct.unpack(byte_order + 'I', file.read(4))[0]
+    file.seek(ifd_offset)
+    entry_count = struct.unpack(byte_order + 'H', file.read(2))[0]
+    entries = file.read(entry_count * 12)
+    for i in range(len(entries) // 12):
+        tag, value_type, count, value = struct.unpack(byte_order + 'HHI4s', entries[i * 12:(i + 1) * 12])
+        if tag == TIFF_TAG_XMP:
+            if count <= 4:
+                return value[:count]
+            file.seek(struct.unpack(byte_order + 'I', value)[0])
+            return file.read(count)
+    return b''
+
+def read_xmp_packet(image_file):
+    # returns None for formats without a native reader, b'' when the image carries no XMP
+    with open(image_file, 'rb') as file:
+        header = file.read(4)
+        try:
+            if header[:2] == b'\xff\xd8':
+                return read_xmp_packet_jpeg(file)
+            if header == b'II*\x00':
+                return read_xmp_packet_tiff(file, '<')
+            if header == b'MM\x00*':
+                return read_xmp_packet_tiff(file, '>')
+        except struct.error:
+            return b''
+    return None
+
+def read_rating_embed(image_file):
+    packet = read_xmp_packet(image_file)
+    if packet:
+        return get_rating_xmp_packet(packet)
+
+    if packet is None and file_to_dict:
+        xmp = file_to_dict(image_file)
+        if xmp and XMP_NS_XAP in xmp:
+            for tpl in xmp[XMP_NS_XAP]:
+                if tpl[0] == "xmp:Rating":
+                    return int(tpl[1])
+    return None
 
 def get_rating_embed(file):
-    xmp = file_to_dict(file)
-    if xmp:
-        for tpl in xmp["http://ns.adobe.com/xap/1.0/"]:
-            if tpl[0] == "xmp:Rating":
-                return tpl[1]
-    return 0
+    rating = read_rating_embed(file)
+    return rating if rating is not None else 0
 
 def is_deleted_pp3(pp3_file):
     file = open(pp3_file,'r')
@@ -54,14 +181,155 @@ def is_deleted_pp3(pp3_file):
         if line.startswith("InTrash"): return line.rstrip('\n').split('=')[1] == 'true'
 
     return False
-def get_metadata_files(local_repo_path):
-    return glob.iglob(local_repo_path + '/**/*.[xpXP][mpMP][p3P]', recursive=True)
-
-def get_related_files(metadata_file, local_repo_path):
-    files = []
-    filename = os.path.splitext(metadata_file)[0]
-    print ("match_criteria:", filename)
-    for file_to_upload in glob.iglob(filename + '*'):
-        rel_path = os.path.relpath(file_to_upload, local_repo_path)
-        files.append(rel_path)
-    return files
\ No newline at end of file
+def get_ratings_for_files(files, jobs=1):
+    if jobs <= 1 or len(files) < PARALLEL_MIN_FILES:
+        return [get_rating(file) for file in files]
+
+    # fork keeps the workers from re-running the command line entry point
+    mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context) as executor:
+        return list(executor.map(get_rating, files, chunksize=PARALLEL_CHUNK_SIZE))
+
+def get_ratings(local_repo_path, rated_files, jobs=1):
+    conn = repo_db.connect(local_repo_path)
+    indexed = repo_db.get_rating_index(conn)
+
+    changed = []
+    present = set()
+    for rel_path in rated_files:
+        stat = os.stat(local_repo_path + rel_path)
+        present.add(rel_path)
+        if indexed.get(rel_path) != (stat.st_mtime_ns, stat.st_size):
+            changed.append((rel_path, stat.st_mtime_ns, stat.st_size))
+
+    ratings = get_ratings_for_files([local_repo_path + row[0] for row in changed], jobs)
+    repo_db.set_ratings(conn, [row + (r,) for row, r in zip(changed, ratings)])
+    repo_db.remove_ratings(conn, [path for path in indexed if path not in present and not os.path.exists(local_repo_path + path)])
+    conn.commit()
+
+    ratings = [row for row in repo_db.get_ratings(conn) if row[0] in present]
+    conn.close()
+    return ratings
+
+def get_rated_stems(local_repo_path, metadata_files, rating, jobs=1):
+    stems = {}
+    for file, r in get_ratings(local_repo_path, metadata_files, jobs):
+        if r is not None and r >= rating:
+            dir_path, stem = os.path.split(os.path.splitext(file)[0])
+            stems.setdefault(dir_path, set()).add(stem)
+    return stems
+
+def is_rated_file(file, rated_stems):
+    dir_path, file_name = os.path.split(file)
+    stems = rated_stems.get(dir_path)
+    return bool(stems) and any(stem in stems for stem in get_candidate_stems(file_name))
+
+def read_patterns(pattern_file):
+    if not os.path.exists(pattern_file):
+        return []
+
+    with open(pattern_file) as file:
+        return [line.strip() for line in file if line.strip() and not line.startswith('#')]
+
+def match_pattern(rel_path, is_dir, pattern):
+    if pattern.endswith('/'):
+        if not is_dir: return False
+        pattern = pattern.rstrip('/')
+
+    if pattern.startswith('/'):
+        return fnmatch(rel_path, pattern[1:])
+    if '/' in pattern:
+        return fnmatch(rel_path, pattern) or fnmatch(rel_path, '*/' + pattern)
+    return fnmatch(os.path.basename(rel_path), pattern)
+
+def match_patterns(rel_path, is_dir, patterns):
+    for pattern in patterns:
+        if match_pattern(rel_path, is_dir, pattern): return True
+    return False
+
+def get_group(repo_index, stem):
+    if stem not in repo_index['groups']:
+        repo_index['groups'][stem] = {'image': [], 'sidecars': [], 'derivatives': []}
+    return repo_index['groups'][stem]
+
+def get_candidate_stems(name):
+    # a file belongs to the group of its own name, of every stem cut at a '.' (IMG_1.cr2.xmp, IMG_1.cr2)
+    # and of every stem cut at a derivative separator (IMG_1_hdr.tif), but never to a bare prefix like IMG_1 of IMG_10
+    return [name] + [name[:i] for i in range(1, len(name)) if name[i] == '.' or name[i] in DERIVATIVE_SEPARATORS]
+
+def index_dir(repo_index, rel_dir, names, ignore_rating_patterns):
+    names.sort()
+    stems = set()
+    for name in names:
+        rel_path = rel_dir + name
+        repo_index['files'].append(rel_path)
+
+        if ignore_rating_patterns and match_patterns(rel_path, False, ignore_rating_patterns):
+            repo_index['ignored_ratings'].append(rel_path)
+
+        stem, ext = os.path.splitext(name)
+        if ext.lower() in METADATA_EXTENSIONS:
+            repo_index['metadata_files'].append(rel_path)
+            stems.add(stem)
+
+    for name in names:
+        grouped = False
+        for stem in get_candidate_stems(name):
+            if stem not in stems: continue
+            grouped = True
+            group = get_group(repo_index, rel_dir + stem)
+            if os.path.splitext(name)[1].lower() in SIDECAR_EXTENSIONS:
+                group['sidecars'].append(rel_dir + name)
+            elif name == stem or os.path.splitext(name)[0] == stem:
+                group['image'].append(rel_dir + name)
+            else:
+                group['derivatives'].append(rel_dir + name)
+
+        if not grouped and os.path.splitext(name)[1].lower() in EMBED_EXTENSIONS:
+            repo_index['standalone_images'].append(rel_dir + name)
+
+def scan_repo(local_repo_path, ignore_patterns=[], ignore_rating_patterns=[]):
+    repo_index = {'files': [], 'metadata_files': [], 'standalone_images': [], 'commit_dirs': [], 'groups': {}, 'ignored_ratings': []}
+
+    dirs = ['']
+    while dirs:
+        rel_dir = dirs.pop()
+        names = []
+        with os.scandir(local_repo_path + rel_dir) as entries:
+            for entry in entries:
+                rel_path = rel_dir + entry.name
+                if entry.name.startswith('.'):
+                    if entry.name == COMMIT_DIR and entry.is_dir(): repo_index['commit_dirs'].append(rel_path + os.path.sep)
+                    continue
+                is_dir = entry.is_dir()
+                if ignore_patterns and match_patterns(rel_path, is_dir, ignore_patterns): continue
+                if is_dir: dirs.append(rel_path + os.path.sep)
+                else: names.append(entry.name)
+        index_dir(repo_index, rel_dir, names, ignore_rating_patterns)
+
+    return repo_index
+
+def get_rated_files(repo_index, embedded_ratings=False):
+    if embedded_ratings:
+        return repo_index['metadata_files'] + repo_index['standalone_images']
+    return repo_index['metadata_files']
+
+def get_index_ratings(local_repo_path, repo_index, embedded_ratings=False, jobs=1):
+    # ratings are kept on the index so that several remotes pushed from one scan share them
+    key = 'embedded_ratings' if embedded_ratings else 'ratings'
+    if key not in repo_index:
+        repo_index[key] = get_ratings(local_repo_path, get_rated_files(repo_index, embedded_ratings), jobs)
+    return repo_index[key]
+
+def get_files_by_rating(local_repo_path, repo_index, rating, embedded_ratings=False, jobs=1):
+    files = set(repo_index['ignored_ratings'])
+    for file, r in get_index_ratings(local_repo_path, repo_index, embedded_ratings, jobs):
+        if r is not None and r >= rating:
+            files.update(get_related_files(repo_index, file))
+    return sorted(files)
+
+def get_related_files(repo_index, metadata_file):
+    if os.path.splitext(metadata_file)[1].lower() not in METADATA_EXTENSIONS:
+        return [metadata_file]
+    group = repo_index['groups'][os.path.splitext(metadata_file)[0]]
+    return sorted(group['image'] + group['sidecars'] + group['derivatives'])
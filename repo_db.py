@@ -0,0 +1,171 @@
+import os
+import sqlite3
+from app_config import DB_FILE_NAME, DELETE_LOG_NAME
+
+DB_FILE = ".pixync" + os.path.sep + DB_FILE_NAME
+DELETE_LOG_FILE = ".pixync" + os.path.sep + DELETE_LOG_NAME
+MIGRATED_SUFFIX = '.migrated'
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS 'rating_index' ('path' TEXT, 'mtime' INTEGER, 'size' INTEGER, 'rating' INTEGER, PRIMARY KEY ('path'))",
+    "CREATE TABLE IF NOT EXISTS 'hash_index' ('path' TEXT, 'size' INTEGER, 'partial_hash' TEXT, 'full_hash' TEXT, PRIMARY KEY ('path'))",
+    "CREATE INDEX IF NOT EXISTS 'hash_index_size' ON 'hash_index' ('size')",
+    "CREATE TABLE IF NOT EXISTS 'push_journal' ('repo' TEXT, 'path' TEXT, 'mtime' INTEGER, 'digest' TEXT, PRIMARY KEY ('repo', 'path'))",
+    "CREATE TABLE IF NOT EXISTS 'tombstone' ('path' TEXT, 'deleted' INTEGER, PRIMARY KEY ('path'))",
+    "CREATE TABLE IF NOT EXISTS 'tombstone_remote' ('path' TEXT, 'repo' TEXT, PRIMARY KEY ('path', 'repo'))",
+    "CREATE TABLE IF NOT EXISTS 'cleanup_plan' ('run' INTEGER, 'path' TEXT, PRIMARY KEY ('run', 'path'))",
+    "CREATE TABLE IF NOT EXISTS 'gdrive_state' ('repo' TEXT, 'root_id' TEXT, 'page_token' TEXT, PRIMARY KEY ('repo'))",
+    "CREATE TABLE IF NOT EXISTS 'md5_cache' ('path' TEXT, 'mtime' INTEGER, 'size' INTEGER, 'md5' TEXT, PRIMARY KEY ('path'))",
+    "CREATE TABLE IF NOT EXISTS 'upload_session' ('repo' TEXT, 'path' TEXT, 'size' INTEGER, 'mtime' INTEGER, 'uri' TEXT, 'offset' INTEGER, 'created' INTEGER, PRIMARY KEY ('repo', 'path'))",
+    "CREATE TABLE IF NOT EXISTS 'sidecar_bundle' ('repo' TEXT, 'dir' TEXT, 'md5' TEXT, 'members' TEXT, PRIMARY KEY ('repo', 'dir'))",
+    "CREATE TABLE IF NOT EXISTS 'gdrive_item' ('repo' TEXT, 'id' TEXT, 'name' TEXT, 'parent' TEXT, 'mime_type' TEXT, 'size' TEXT, 'md5' TEXT, 'modified' TEXT, PRIMARY KEY ('repo', 'id'))",
+]
+
+def connect(local_repo_path):
+    conn = sqlite3.connect(local_repo_path + DB_FILE)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    migrate_delete_log(conn, local_repo_path)
+    return conn
+
+def migrate_delete_log(conn, local_repo_path):
+    delete_log = local_repo_path + DELETE_LOG_FILE
+    try:
+        with open(delete_log) as file:
+            paths = set(line.rstrip('\n') for line in file if line.strip())
+        deleted = int(os.path.getmtime(delete_log))
+    except FileNotFoundError:
+        return
+
+    conn.executemany("INSERT OR IGNORE INTO tombstone VALUES (?, ?)", [(path, deleted) for path in paths])
+    conn.commit()
+    os.replace(delete_log, delete_log + MIGRATED_SUFFIX)
+
+def get_rating_index(conn):
+    index = {}
+    for path, mtime, size in conn.execute("SELECT path, mtime, size FROM rating_index"):
+        index[path] = (mtime, size)
+    return index
+
+def set_ratings(conn, rows):
+    conn.executemany("INSERT OR REPLACE INTO rating_index VALUES (?, ?, ?, ?)", rows)
+
+def remove_ratings(conn, paths):
+    conn.executemany("DELETE FROM rating_index WHERE path=?", [(path,) for path in paths])
+
+def get_ratings(conn):
+    return conn.execute("SELECT path, rating FROM rating_index ORDER BY path").fetchall()
+
+def get_hashes_by_size(conn, size):
+    return conn.execute("SELECT path, partial_hash, full_hash FROM hash_index WHERE size=?", (size,)).fetchall()
+
+def set_hashes(conn, rows):
+    conn.executemany("INSERT OR REPLACE INTO hash_index VALUES (?, ?, ?, ?)", rows)
+
+def set_full_hash(conn, path, full_hash):
+    conn.execute("UPDATE hash_index SET full_hash=? WHERE path=?", (full_hash, path))
+
+def remove_hashes(conn, paths):
+    conn.executemany("DELETE FROM hash_index WHERE path=?", [(path,) for path in paths])
+
+def clear_hashes(conn):
+    conn.execute("DELETE FROM hash_index")
+
+def get_push_journal(conn, repo):
+    journal = {}
+    for path, digest in conn.execute("SELECT path, digest FROM push_journal WHERE repo=?", (repo,)):
+        journal[path] = digest
+    return journal
+
+def set_push_journal(conn, repo, digests):
+    conn.execute("DELETE FROM push_journal WHERE repo=?", (repo,))
+    conn.executemany("INSERT INTO push_journal VALUES (?, ?, ?, ?)",
+        [(repo, path, mtime, digest) for path, (mtime, digest) in digests.items()])
+
+def add_tombstones(conn, paths, deleted):
+    conn.executemany("INSERT OR REPLACE INTO tombstone VALUES (?, ?)", [(path, deleted) for path in paths])
+    conn.executemany("DELETE FROM tombstone_remote WHERE path=?", [(path,) for path in paths])
+
+def remove_tombstones(conn, paths):
+    conn.executemany("DELETE FROM tombstone WHERE path=?", [(path,) for path in paths])
+    conn.executemany("DELETE FROM tombstone_remote WHERE path=?", [(path,) for path in paths])
+
+def get_tombstones(conn, repo=None):
+    if repo is None:
+        return [row[0] for row in conn.execute("SELECT path FROM tombstone ORDER BY path")]
+    return [row[0] for row in conn.execute("SELECT path FROM tombstone WHERE path NOT IN "
+        "(SELECT path FROM tombstone_remote WHERE repo=?) ORDER BY path", (repo,))]
+
+def set_tombstones_applied(conn, repo, paths):
+    conn.executemany("INSERT OR IGNORE INTO tombstone_remote VALUES (?, ?)", [(path, repo) for path in paths])
+
+def compact_tombstones(conn, repos):
+    # a tombstone applied on every remote has nothing left to delete or to keep out
+    if not repos:
+        return 0
+    placeholders = ', '.join('?' * len(repos))
+    count = conn.execute("DELETE FROM tombstone WHERE (SELECT COUNT(DISTINCT repo) FROM tombstone_remote "
+        "WHERE tombstone_remote.path=tombstone.path AND repo IN ({})) = ?".format(placeholders), list(repos) + [len(repos)]).rowcount
+    conn.execute("DELETE FROM tombstone_remote WHERE path NOT IN (SELECT path FROM tombstone)")
+    return count
+
+def add_cleanup_plan(conn, run, paths):
+    conn.executemany("INSERT OR IGNORE INTO cleanup_plan VALUES (?, ?)", [(run, path) for path in paths])
+
+def get_last_cleanup_plan(conn):
+    row = conn.execute("SELECT MAX(run) FROM cleanup_plan").fetchone()
+    if row[0] is None:
+        return None, []
+    return row[0], [row[0] for row in conn.execute("SELECT path FROM cleanup_plan WHERE run=? ORDER BY path", (row[0],))]
+
+def remove_cleanup_plan(conn, run):
+    conn.execute("DELETE FROM cleanup_plan WHERE run=?", (run,))
+
+def get_md5_cache(conn, paths):
+    cache = {}
+    for path in paths:
+        row = conn.execute("SELECT mtime, size, md5 FROM md5_cache WHERE path=?", (path,)).fetchone()
+        if row: cache[path] = row
+    return cache
+
+def set_md5s(conn, rows):
+    conn.executemany("INSERT OR REPLACE INTO md5_cache VALUES (?, ?, ?, ?)", rows)
+
+def get_gdrive_state(conn, repo):
+    return conn.execute("SELECT root_id, page_token FROM gdrive_state WHERE repo=?", (repo,)).fetchone()
+
+def get_gdrive_items(conn, repo):
+    # the rows are streamed, a large tree is never held twice
+    return conn.execute("SELECT id, name, parent, mime_type, size, md5, modified FROM gdrive_item WHERE repo=?", (repo,))
+
+def set_gdrive_state(conn, repo, root_id, page_token):
+    conn.execute("INSERT OR REPLACE INTO gdrive_state VALUES (?, ?, ?)", (repo, root_id, page_token))
+
+def set_gdrive_items(conn, repo, rows):
+    conn.execute("DELETE FROM gdrive_item WHERE repo=?", (repo,))
+    conn.executemany("INSERT INTO gdrive_item VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [(repo,) + tuple(row) for row in rows])
+
+def update_gdrive_items(conn, repo, rows):
+    conn.executemany("INSERT OR REPLACE INTO gdrive_item VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [(repo,) + tuple(row) for row in rows])
+
+def remove_gdrive_items(conn, repo, ids):
+    conn.executemany("DELETE FROM gdrive_item WHERE repo=? AND id=?", [(repo, id) for id in ids])
+
+def remove_gdrive_state(conn, repo):
+    conn.execute("DELETE FROM gdrive_state WHERE repo=?", (repo,))
+    conn.execute("DELETE FROM gdrive_item WHERE repo=?", (repo,))
+
+def get_upload_session(conn, repo, path):
+    return conn.execute("SELECT size, mtime, uri, offset, created FROM upload_session WHERE repo=? AND path=?", (repo, path)).fetchone()
+
+def set_upload_session(conn, repo, path, size, mtime, uri, offset, created):
+    conn.execute("INSERT OR REPLACE INTO upload_session VALUES (?, ?, ?, ?, ?, ?, ?)", (repo, path, size, mtime, uri, offset, created))
+
+def remove_upload_session(conn, repo, path):
+    conn.execute("DELETE FROM upload_session WHERE repo=? AND path=?", (repo, path))
+
+def get_sidecar_bundle(conn, repo, dir):
+    return conn.execute("SELECT md5, members FROM sidecar_bundle WHERE repo=? AND dir=?", (repo, dir)).fetchone()
+
+def set_sidecar_bundle(conn, repo, dir, md5, members):
+    conn.execute("INSERT OR REPLACE INTO sidecar_bundle VALUES (?, ?, ?, ?)", (repo, dir, md5, members))
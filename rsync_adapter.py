@@ -0,0 +1,316 @@
+import os
+import time
+import heapq
+import subprocess
+import metadata_util
+import repo_db
+
+IGNORE_FILE = ".pixignore"
+TOMBSTONE_FILTER_FILE = ".pixync" + os.path.sep + "tombstone.{}.filter"
+PUSH_MANIFEST_FILE = ".pixync" + os.path.sep + "push.{}.manifest"
+PUSH_FILTER_FILE = ".pixync" + os.path.sep + "push.{}.filter"
+PULL_MANIFEST_FILE = ".pixync" + os.path.sep + "pull.{}.manifest"
+SHARD_MANIFEST_FILE = ".pixync" + os.path.sep + "shard.{}.{}.manifest"
+SHARD_POLL_INTERVAL = 1
+verbose = False
+quiet = False
+jobs = 1
+local_repo_path = None
+repo_index = None
+settings = {}
+
+def set_config(config):
+    global settings
+    settings = config
+
+def escape_pattern(path):
+    for c in '\\*?[':
+        path = path.replace(c, '\\' + c)
+    return path
+
+def write_lines(path, lines):
+    with open(path, 'w') as file:
+        for line in lines:
+            file.write(line)
+            file.write('\n')
+
+def get_exclude_options():
+    return ['--exclude=.pixync/', '--exclude=.trash/', '--exclude-from=' + local_repo_path + IGNORE_FILE]
+
+def get_rsync_command(dry_run, options, source, target, progress=True):
+    command = ['rsync', '-urtW']
+
+    if not quiet and progress:
+        command.extend(['--progress', '-v'])
+
+    if dry_run:
+        command.append('--dry-run')
+
+    command.extend(get_exclude_options())
+    command.extend(options)
+    command.extend([source, target])
+    return command
+
+def get_tombstones(remote_repo_name):
+    # tombstones already applied on the remote and files that are back in the tree are left out
+    conn = repo_db.connect(local_repo_path)
+    tombstones = repo_db.get_tombstones(conn, remote_repo_name)
+    conn.close()
+    return [file for file in tombstones if not os.path.lexists(local_repo_path + file)]
+
+def set_tombstones_applied(remote_repo_name, tombstones):
+    conn = repo_db.connect(local_repo_path)
+    repo_db.set_tombstones_applied(conn, remote_repo_name, tombstones)
+    conn.commit()
+    conn.close()
+
+def compact_tombstones(remote_repo_names):
+    conn = repo_db.connect(local_repo_path)
+    count = repo_db.compact_tombstones(conn, remote_repo_names)
+    conn.commit()
+    conn.close()
+    if verbose and count: print("{} tombstones applied on every remote were dropped".format(count))
+
+def get_tombstone_patterns(tombstones):
+    # every rule is an exact anchored path, a stem or directory wildcard would also reach
+    # remote files that were never deleted here, like groups pushed from another clone
+    return ['/' + escape_pattern(file) for file in sorted(tombstones)]
+
+def get_tombstone_options(remote_repo_name):
+    tombstones = get_tombstones(remote_repo_name)
+    if not tombstones:
+        return []
+
+    filter_file = local_repo_path + TOMBSTONE_FILTER_FILE.format(remote_repo_name)
+    write_lines(filter_file, get_tombstone_patterns(tombstones))
+    return ['--exclude-from=' + filter_file]
+
+def scan_repo():
+    if repo_index is not None:
+        return repo_index
+
+    return metadata_util.scan_repo(local_repo_path,
+        metadata_util.read_patterns(local_repo_path + IGNORE_FILE), settings.get('ignore-ratings', []))
+
+def in_changed_dirs(file, changed_dirs):
+    return changed_dirs is None or os.path.dirname(file.rstrip(os.path.sep)) in changed_dirs
+
+def is_ignored(path, ignore_patterns):
+    parts = path.rstrip(os.path.sep).split(os.path.sep)
+    for i in range(1, len(parts) + 1):
+        if metadata_util.match_patterns(os.path.sep.join(parts[:i]), i < len(parts) or path.endswith(os.path.sep), ignore_patterns): return True
+    return False
+
+def get_dot_files(changed_dirs):
+    # the index leaves dotfiles like .pixignore out, the plain mirror push always carried them
+    ignore_patterns = metadata_util.read_patterns(local_repo_path + IGNORE_FILE)
+    files = []
+    for dir_path in sorted(changed_dirs):
+        # a directory under a dot directory goes up with it
+        if any(part.startswith('.') for part in dir_path.split(os.path.sep)): continue
+        if dir_path and is_ignored(dir_path + os.path.sep, ignore_patterns): continue
+        with os.scandir(os.path.join(local_repo_path, dir_path)) as entries:
+            for entry in entries:
+                if not entry.name.startswith('.') or entry.name == metadata_util.COMMIT_DIR: continue
+                if dir_path == '' and entry.name in ('.pixync', '.trash'): continue
+                path = os.path.join(dir_path, entry.name) + (os.path.sep if entry.is_dir(follow_symlinks=False) else '')
+                if not is_ignored(path, ignore_patterns): files.append(path)
+    return files
+
+def get_push_files(rating, changed_dirs=None):
+    local_index = scan_repo()
+    if rating > 0:
+        files = metadata_util.get_files_by_rating(local_repo_path, local_index, rating, settings.get('embedded-ratings', False), jobs)
+        if verbose: print("{} files qualify for rating >= {}".format(len(files), rating))
+    else:
+        files = list(local_index['files'])
+
+    files = [file for file in files if in_changed_dirs(file, changed_dirs)]
+    if rating <= 0:
+        files.extend(get_dot_files(changed_dirs if changed_dirs is not None else set(os.path.dirname(file) for file in [''] + files)))
+    commit_dirs = [commit_dir for commit_dir in local_index['commit_dirs'] if in_changed_dirs(commit_dir, changed_dirs)]
+    if verbose and changed_dirs is not None: print("{} files in {} changed directories".format(len(files), len(changed_dirs)))
+    return files, commit_dirs
+
+def plan_push(remote_repo_name, remote_repo_url, rating, delete, forced_delete, dry_run, changed_dirs=None, tombstones=[]):
+    # one rsync run covers the content, the .commit markers and the tombstone deletions
+    options = []
+
+    if (rating > 0 or changed_dirs is not None) and not forced_delete:
+        files, commit_dirs = get_push_files(rating, changed_dirs)
+        manifest = files + commit_dirs
+
+        if delete and tombstones:
+            manifest.extend(tombstones)
+            options.append('--delete-missing-args')
+
+        manifest_file = local_repo_path + PUSH_MANIFEST_FILE.format(remote_repo_name)
+        write_lines(manifest_file, manifest)
+        options.append('--files-from=' + manifest_file)
+
+    elif forced_delete:
+        if verbose and rating > 0: print("forced delete mirrors the whole tree, the rating filter is not applied")
+        options.append('--delete')
+
+    elif delete:
+        if tombstones:
+            filter_file = local_repo_path + PUSH_FILTER_FILE.format(remote_repo_name)
+            write_lines(filter_file, ['R ' + pattern for pattern in get_tombstone_patterns(tombstones)] + ['P *'])
+            options.extend(['--delete', '--filter=merge ' + filter_file])
+
+    return get_rsync_command(dry_run, options, local_repo_path, remote_repo_url)
+
+def get_shard_key(file):
+    dir_path, file_name = os.path.split(file.rstrip(os.path.sep))
+    date = file_name[:8] if file_name[:8].isdigit() else ''
+    return dir_path, date
+
+def plan_shards(files, sizes, shard_count):
+    # files are grouped by directory and capture date, then spread over the shards largest first
+    units = {}
+    for file in files:
+        unit = units.setdefault(get_shard_key(file), [0, []])
+        unit[0] += sizes.get(file, 0)
+        unit[1].append(file)
+
+    shards = [[0, index, []] for index in range(shard_count)]
+    for size, unit_files in sorted(units.values(), key=lambda unit: (-unit[0], unit[1][0])):
+        shard = heapq.heappop(shards)
+        shard[0] += size
+        shard[2].extend(unit_files)
+        heapq.heappush(shards, shard)
+
+    return [shard[2] for shard in sorted(shards, key=lambda shard: shard[1]) if shard[2]]
+
+def run_shards(commands, shard_files, sizes):
+    processes = [subprocess.Popen(command, stdout=subprocess.DEVNULL) for command in commands]
+    total_files = sum(len(files) for files in shard_files)
+    total_bytes = sum(sizes.values()) or 1
+
+    returncode = 0
+    pending = list(range(len(processes)))
+    done_files = 0
+    done_bytes = 0
+    while pending:
+        for index in list(pending):
+            if processes[index].poll() is None: continue
+            pending.remove(index)
+            returncode = returncode or processes[index].returncode
+            done_files += len(shard_files[index])
+            done_bytes += sum(sizes.get(file, 0) for file in shard_files[index])
+            if verbose: print('> {:<60}{:>13}'.format('shard {} of {}'.format(index + 1, len(processes)),
+                'completed' if processes[index].returncode == 0 else 'failed'))
+
+        if not quiet:
+            status = '{} of {} shards, {} of {} files'.format(len(processes) - len(pending), len(processes), done_files, total_files)
+            print('> {:<60}{:>13}'.format(status, '[{}%]'.format(int(done_bytes * 100 / total_bytes))), end='\r' if pending else '\n')
+        if pending: time.sleep(SHARD_POLL_INTERVAL)
+
+    return returncode
+
+def write_shard_commands(remote_repo_name, shards, source, target, dry_run, options=[]):
+    commands = []
+    for index, shard_files in enumerate(shards):
+        manifest = local_repo_path + SHARD_MANIFEST_FILE.format(remote_repo_name, index)
+        write_lines(manifest, shard_files)
+        shard_options = list(options[index]) if index < len(options) else []
+        commands.append(get_rsync_command(dry_run, shard_options + ['--files-from=' + manifest], source, target, False))
+    return commands
+
+def push_parallel(remote_repo_name, remote_repo_url, rating, delete, dry_run, shard_count, changed_dirs=None, tombstones=[]):
+    files, commit_dirs = get_push_files(rating, changed_dirs)
+
+    sizes = {file: os.path.getsize(local_repo_path + file) for file in files}
+    shards = plan_shards(files + commit_dirs, sizes, shard_count) or [[]]
+
+    options = []
+    if delete and tombstones:
+        shards[0] = shards[0] + tombstones
+        options.append(['--delete-missing-args'])
+
+    if verbose: print("{} files in {} shards".format(len(files), len(shards)))
+    return run_shards(write_shard_commands(remote_repo_name, shards, local_repo_path, remote_repo_url, dry_run, options), shards, sizes)
+
+def push(remote_repo_name, remote_repo_url, rating, delete, forced_delete, dry_run, parallel=1, changed_dirs=None):
+    tombstones = get_tombstones(remote_repo_name) if delete or forced_delete else []
+
+    if parallel > 1:
+        returncode = push_parallel(remote_repo_name, remote_repo_url, rating, delete, dry_run, parallel, changed_dirs, tombstones)
+    else:
+        returncode = subprocess.call(plan_push(remote_repo_name, remote_repo_url, rating, delete, forced_delete, dry_run, changed_dirs, tombstones))
+
+    if returncode == 0 and tombstones and not dry_run:
+        set_tombstones_applied(remote_repo_name, tombstones)
+    return returncode
+
+def pull_sidecars(remote_repo_name, remote_repo_url, dry_run):
+    options = get_tombstone_options(remote_repo_name) + ['--include=*/', '--include=*.[xX][mM][pP]', '--include=*.[pP][pP]3', '--exclude=*']
+
+    if verbose: print('Pulling the sidecars to evaluate the ratings.')
+    return subprocess.call(get_rsync_command(dry_run, options, remote_repo_url, local_repo_path))
+
+def list_remote_files(remote_repo_url, options):
+    command = ['rsync', '-r', '--list-only'] + get_exclude_options() + options + [remote_repo_url]
+    output = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+
+    files = []
+    sizes = {}
+    for line in output.stdout.splitlines():
+        fields = line.split(None, 4)
+        if len(fields) < 5 or fields[0].startswith('d'): continue
+        path = fields[4].split(' -> ')[0] if fields[0].startswith('l') else fields[4]
+        files.append(path)
+        sizes[path] = int(''.join(c for c in fields[1] if c.isdigit()) or 0)
+    return output.returncode, files, sizes
+
+def get_pull_files(remote_repo_name, remote_repo_url, rating=None):
+    # the remote listing is matched against the rated stems with set lookups, and the transfer
+    # gets a plain file list instead of one include rule per rated group
+    returncode, files, sizes = list_remote_files(remote_repo_url, get_tombstone_options(remote_repo_name))
+    if returncode != 0 or not rating:
+        return returncode, files, sizes
+
+    local_index = metadata_util.scan_repo(local_repo_path, metadata_util.read_patterns(local_repo_path + IGNORE_FILE))
+    rated_stems = metadata_util.get_rated_stems(local_repo_path, local_index['metadata_files'], rating, jobs)
+    ignore_rating_patterns = settings.get('ignore-ratings', [])
+    files = [file for file in files if metadata_util.is_rated_file(file, rated_stems) or metadata_util.match_patterns(file, False, ignore_rating_patterns)]
+    if verbose: print("{} remote files qualify for rating >= {}".format(len(files), rating))
+    return returncode, files, sizes
+
+def plan_pull(remote_repo_name, remote_repo_url, delete, dry_run, files=None):
+    options = get_tombstone_options(remote_repo_name)
+
+    if files is not None:
+        manifest_file = local_repo_path + PULL_MANIFEST_FILE.format(remote_repo_name)
+        write_lines(manifest_file, files)
+        options.append('--files-from=' + manifest_file)
+
+    if delete:
+        options.insert(0, '--delete')
+
+    return get_rsync_command(dry_run, options, remote_repo_url, local_repo_path)
+
+def pull_parallel(remote_repo_name, remote_repo_url, dry_run, rating, shard_count):
+    returncode, files, sizes = get_pull_files(remote_repo_name, remote_repo_url, rating)
+    if returncode != 0:
+        return returncode
+
+    shards = plan_shards(files, sizes, shard_count)
+    if verbose: print("{} files in {} shards".format(len(files), len(shards)))
+    return run_shards(write_shard_commands(remote_repo_name, shards, remote_repo_url, local_repo_path, dry_run), shards, sizes)
+
+def pull(remote_repo_name, remote_repo_url, delete, dry_run, rating=None, parallel=1):
+    if rating:
+        returncode = pull_sidecars(remote_repo_name, remote_repo_url, dry_run)
+        if returncode != 0:
+            return returncode
+
+    if parallel > 1:
+        return pull_parallel(remote_repo_name, remote_repo_url, dry_run, rating, parallel)
+
+    files = None
+    if rating:
+        returncode, files, sizes = get_pull_files(remote_repo_name, remote_repo_url, rating)
+        if returncode != 0:
+            return returncode
+    return subprocess.call(plan_pull(remote_repo_name, remote_repo_url, delete, dry_run, files))
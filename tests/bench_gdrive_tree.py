@@ -0,0 +1,117 @@
+"""Load time, peak RSS and lookup time of the GDrive tree cache on a synthetic repo.
+
+    python tests/bench_gdrive_tree.py [--folders 500] [--files 999] [--module path/to/gdrive_adapter.py]
+
+The cache is written and loaded in two fresh subprocesses. A forked child inherits the max RSS of
+its parent, so the parent stays small and the reported max RSS is that of the load alone.
+To compare with another revision, check it out with git worktree and pass its gdrive_adapter.py.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import resource
+import tempfile
+import argparse
+import subprocess
+import importlib.util
+from types import SimpleNamespace
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+REPO_KEY = 'ROOT/repo'
+MODIFIED = '2022-01-01T00:00:00.000Z'
+LOOKUPS = 100000
+
+def get_file_name(folder, file):
+    return '2022{:04d}_cam1_IMG_{:04d}.{}'.format(folder, file, ('CR3', 'xmp', 'jpg')[file % 3])
+
+def write_cache(repo_path, folders, files):
+    sys.path.insert(0, REPO_DIR)
+    import repo_db
+
+    rows = []
+    for folder in range(folders):
+        year_id = 'Y{:02d}'.format(folder // 50).ljust(32, 'x')
+        if folder % 50 == 0:
+            rows.append((year_id, str(2000 + folder // 50), 'ROOT', FOLDER_MIME_TYPE, None, None, MODIFIED))
+        folder_id = 'M{:05d}'.format(folder).ljust(32, 'x')
+        rows.append((folder_id, 'shoot_{:03d}'.format(folder % 50), year_id, FOLDER_MIME_TYPE, None, None, MODIFIED))
+        for file in range(files):
+            rows.append(('F{:05d}{:04d}'.format(folder, file).ljust(32, 'x'), get_file_name(folder % 50, file), folder_id, 'image/jpeg',
+                str(1000 + file * 4000), hashlib.md5(folder_id.encode() + str(file).encode()).hexdigest(), MODIFIED))
+
+    os.makedirs(repo_path + '.pixync')
+    conn = repo_db.connect(repo_path)
+    repo_db.set_gdrive_items(conn, REPO_KEY, rows)
+    repo_db.set_gdrive_state(conn, REPO_KEY, 'ROOT', '1')
+    conn.commit()
+    conn.close()
+    return len(rows)
+
+def get_max_rss():
+    # kilobytes on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+def run_child(repo_path, module_path, folders, files):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(module_path)))
+    spec = importlib.util.spec_from_file_location('gdrive_adapter', module_path)
+    gdrive_adapter = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(gdrive_adapter)
+
+    # an empty changes feed, so refresh_tree only reads the cache
+    request = SimpleNamespace(execute=lambda: {'changes': [], 'newStartPageToken': '1'})
+    gdrive_adapter.gdrive_service = SimpleNamespace(changes=lambda: SimpleNamespace(list=lambda **kwargs: request))
+    gdrive_adapter.local_repo_path = repo_path
+    gdrive_adapter.gdrive_repo_url = REPO_KEY.split('/')
+    gdrive_adapter.gdrive_repo_root = {'id': 'ROOT', 'name': 'repo', 'mimeType': FOLDER_MIME_TYPE}
+
+    rss_before = get_max_rss()
+    start = time.perf_counter()
+    gdrive_adapter.refresh_tree()
+    load_time = time.perf_counter() - start
+    rss_after = get_max_rss()
+
+    paths = [os.path.join(str(2000 + folder // 50), 'shoot_{:03d}'.format(folder % 50), get_file_name(folder % 50, i % files))
+        for i, folder in enumerate(i % folders for i in range(LOOKUPS))]
+    start = time.perf_counter()
+    found = sum(1 for path in paths if gdrive_adapter.get_available_file(path) is not None)
+    lookup_time = time.perf_counter() - start
+
+    print(json.dumps({'load': load_time, 'rss_before': rss_before, 'rss_after': rss_after, 'lookups': lookup_time, 'found': found}))
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the GDrive tree cache')
+    parser.add_argument('--folders', type=int, default=500)
+    parser.add_argument('--files', type=int, default=999)
+    parser.add_argument('--module', default=os.path.join(REPO_DIR, 'gdrive_adapter.py'))
+    parser.add_argument('--write', help=argparse.SUPPRESS)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.write:
+        print(write_cache(args.write, args.folders, args.files))
+        return
+    if args.child:
+        run_child(args.child, args.module, args.folders, args.files)
+        return
+
+    repo_path = tempfile.mkdtemp() + os.path.sep
+    try:
+        size_options = ['--folders', str(args.folders), '--files', str(args.files)]
+        items = int(subprocess.run([sys.executable, os.path.abspath(__file__), '--write', repo_path] + size_options,
+            stdout=subprocess.PIPE, check=True).stdout)
+        result = json.loads(subprocess.run([sys.executable, os.path.abspath(__file__), '--child', repo_path, '--module', args.module] + size_options,
+            stdout=subprocess.PIPE, check=True).stdout)
+    finally:
+        shutil.rmtree(repo_path)
+
+    print('{}: {} items'.format(args.module, items))
+    print('load {:.1f}s, max RSS {:.0f} MiB ({:.0f} MiB before the load)'.format(result['load'], result['rss_after'], result['rss_before']))
+    print('{} lookups {:.2f}s, {} found'.format(LOOKUPS, result['lookups'], result['found']))
+
+if __name__ == '__main__':
+    main()
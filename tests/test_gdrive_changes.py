@@ -0,0 +1,168 @@
+import os
+import re
+import sys
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import gdrive_adapter
+    from googleapiclient.errors import HttpError
+except ImportError:
+    gdrive_adapter = None
+import repo_db
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+class FakeRequest:
+
+    def __init__(self, drive, respond):
+        self.drive = drive
+        self.respond = respond
+
+    def execute(self):
+        self.drive.calls.append(self.respond.__name__)
+        return self.respond()
+
+class FakeResponse(dict):
+    status = 404
+    reason = 'Not Found'
+
+class FakeDrive:
+    # a Drive with a changes feed, listing pages are kept small so the paging is exercised
+
+    def __init__(self):
+        self.items = {}
+        self.log = []
+        self.calls = []
+        self.invalid_token = False
+
+    def add(self, id, name, parent, folder=False):
+        self.items[id] = {'id': id, 'name': name, 'parents': [parent], 'mimeType': FOLDER_MIME_TYPE if folder else 'image/jpeg',
+            'size': None if folder else '10', 'md5Checksum': None if folder else 'ab' * 16, 'modifiedTime': '2022-01-01T00:00:00.000Z'}
+        return id
+
+    def change(self, id, **fields):
+        self.items[id].update(fields)
+        self.log.append({'fileId': id, 'file': dict(self.items[id])})
+
+    def files(self):
+        return SimpleNamespace(list=self.list_files)
+
+    def changes(self):
+        return SimpleNamespace(list=self.list_changes, getStartPageToken=self.get_start_page_token)
+
+    def list_files(self, q, spaces, pageSize, pageToken, fields):
+        parents = re.findall(r"'([^']+)' in parents", q)
+        items = [dict(item) for item in self.items.values() if item['parents'][0] in parents and not item.get('trashed')]
+        start = int(pageToken or 0)
+        def files_list():
+            response = {'files': items[start:start + 2]}
+            if start + 2 < len(items): response['nextPageToken'] = str(start + 2)
+            return response
+        return FakeRequest(self, files_list)
+
+    def list_changes(self, pageToken, spaces, pageSize, includeRemoved, fields):
+        def changes_list():
+            if self.invalid_token:
+                raise HttpError(FakeResponse(), b'')
+            return {'changes': self.log[int(pageToken):], 'newStartPageToken': str(len(self.log))}
+        return FakeRequest(self, changes_list)
+
+    def get_start_page_token(self):
+        def changes_get_start_page_token():
+            return {'startPageToken': str(len(self.log))}
+        return FakeRequest(self, changes_get_start_page_token)
+
+@unittest.skipIf(gdrive_adapter is None, 'the Google API client libraries are not installed')
+class ChangesFeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp() + os.path.sep
+        os.makedirs(self.repo_path + '.pixync')
+        self.drive = FakeDrive()
+        self.drive.add('R', 'repo', 'P', True)
+        self.drive.add('A', 'a', 'R', True)
+        for i in range(3):
+            self.drive.add('a{}'.format(i), 'IMG_{}.jpg'.format(i), 'A')
+        self.drive.add('X', 'x', 'P', True)
+        self.drive.add('Y', 'y', 'X', True)
+        self.drive.add('y0', 'IMG_9.jpg', 'Y')
+        self.drive.add('o0', 'other.jpg', 'P')
+
+        gdrive_adapter.local_repo_path = self.repo_path
+        gdrive_adapter.gdrive_repo_url = ['P', 'repo']
+        gdrive_adapter.gdrive_repo_root = dict(self.drive.items['R'])
+        gdrive_adapter.gdrive_service = self.drive
+        gdrive_adapter.verbose = False
+        self.resolve_repo_root = gdrive_adapter.resolve_repo_root
+        gdrive_adapter.resolve_repo_root = lambda: None
+        self.refresh()
+
+    def tearDown(self):
+        gdrive_adapter.resolve_repo_root = self.resolve_repo_root
+        shutil.rmtree(self.repo_path)
+
+    def refresh(self):
+        self.drive.calls = []
+        gdrive_adapter.refresh_tree()
+        gdrive_adapter.write_tree_cache()
+        return self.drive.calls
+
+    def get_cached_paths(self):
+        conn = repo_db.connect(self.repo_path)
+        rows = list(repo_db.get_gdrive_items(conn, gdrive_adapter.get_repo_key()))
+        conn.close()
+        names = {row[0]: (row[1], row[2]) for row in rows}
+        def get_path(id):
+            name, parent = names[id]
+            return name if parent == 'R' else get_path(parent) + '/' + name
+        return sorted(get_path(row[0]) for row in rows)
+
+    def test_first_refresh_builds_the_cache(self):
+        self.assertTrue(gdrive_adapter.tree_rebuilt)
+        self.assertEqual(self.get_cached_paths(), ['a', 'a/IMG_0.jpg', 'a/IMG_1.jpg', 'a/IMG_2.jpg'])
+
+    def test_noop_refresh_is_one_call(self):
+        self.assertEqual(self.refresh(), ['changes_list'])
+        self.assertFalse(gdrive_adapter.is_tree_dirty())
+        self.assertEqual(sorted(path for path, node in gdrive_adapter.walk_tree()), self.get_cached_paths())
+
+    def test_folder_moved_in_gets_its_subtree_listed(self):
+        self.drive.change('X', parents=['A'])
+        self.assertEqual(self.refresh(), ['changes_list', 'files_list', 'files_list'])
+        self.assertFalse(gdrive_adapter.tree_rebuilt)
+        self.assertIsNotNone(gdrive_adapter.get_node('a/x/y/IMG_9.jpg'))
+        self.assertEqual(self.get_cached_paths(), ['a', 'a/IMG_0.jpg', 'a/IMG_1.jpg', 'a/IMG_2.jpg', 'a/x', 'a/x/y', 'a/x/y/IMG_9.jpg'])
+
+    def test_folder_moved_out_leaves_the_cache(self):
+        self.drive.change('A', parents=['P'])
+        self.refresh()
+        self.assertEqual(self.get_cached_paths(), [])
+
+    def test_unrelated_change_leaves_the_cache_clean(self):
+        self.drive.change('o0', name='renamed.jpg')
+        self.drive.change('y0', size='20')
+        self.assertEqual(self.refresh(), ['changes_list'])
+        self.assertFalse(gdrive_adapter.is_tree_dirty())
+
+    def test_changed_file_is_updated_in_place(self):
+        self.drive.change('a1', name='IMG_1b.jpg', trashed=False)
+        self.drive.change('a2', trashed=True)
+        self.refresh()
+        self.assertEqual(set(gdrive_adapter.dirty_nodes), {'a1'})
+        self.assertEqual(set(gdrive_adapter.removed_nodes), {'a2'})
+        self.assertEqual(self.get_cached_paths(), ['a', 'a/IMG_0.jpg', 'a/IMG_1b.jpg'])
+
+    def test_invalid_token_rebuilds_the_cache(self):
+        self.drive.invalid_token = True
+        self.drive.add('a3', 'IMG_3.jpg', 'A')
+        calls = self.refresh()
+        self.assertEqual(calls[:2], ['changes_list', 'changes_get_start_page_token'])
+        self.assertTrue(gdrive_adapter.tree_rebuilt)
+        self.assertIn('a/IMG_3.jpg', self.get_cached_paths())
+
+if __name__ == '__main__':
+    unittest.main()
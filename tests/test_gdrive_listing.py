@@ -0,0 +1,84 @@
+import os
+import re
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import gdrive_adapter
+except ImportError:
+    gdrive_adapter = None
+
+class FakeListRequest:
+
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+class FakeListEndpoint:
+    # answers files().list the way Drive does: parents joined with 'or', paged by pageSize
+
+    def __init__(self, items):
+        self.items = items
+        self.queries = []
+
+    def files(self):
+        return SimpleNamespace(list=self.list)
+
+    def list(self, q, spaces, pageSize, pageToken, fields):
+        self.queries.append((q, pageToken))
+        parents = set(re.findall(r"'([^']+)' in parents", q))
+        files = [item for item in self.items if item['parents'][0] in parents]
+        if 'trashed = false' in q:
+            files = [item for item in files if not item['trashed']]
+        start = int(pageToken or 0)
+        response = {'files': files[start:start + pageSize]}
+        if start + pageSize < len(files):
+            response['nextPageToken'] = str(start + pageSize)
+        return FakeListRequest(response)
+
+@unittest.skipIf(gdrive_adapter is None, 'the Google API client libraries are not installed')
+class ListChildrenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.page_size = gdrive_adapter.LIST_PAGE_SIZE
+        gdrive_adapter.LIST_PAGE_SIZE = 4
+        self.parent_ids = ['p{}'.format(i) for i in range(gdrive_adapter.LIST_PARENTS_PER_QUERY + 5)]
+        items = []
+        for parent_id in self.parent_ids:
+            for i in range(3):
+                items.append({'id': '{}-{}'.format(parent_id, i), 'parents': [parent_id], 'trashed': i == 2})
+        items.append({'id': 'other', 'parents': ['q0'], 'trashed': False})
+        self.endpoint = FakeListEndpoint(items)
+        gdrive_adapter.gdrive_service = self.endpoint
+
+    def tearDown(self):
+        gdrive_adapter.LIST_PAGE_SIZE = self.page_size
+
+    def test_list_files_follows_every_page(self):
+        files = gdrive_adapter.list_files("'p0' in parents or 'p1' in parents or 'p2' in parents")
+        self.assertEqual(len(files), 9)
+        self.assertEqual([token for q, token in self.endpoint.queries], [None, '4', '8'])
+
+    def test_children_of_many_parents_are_listed_in_batches(self):
+        children = gdrive_adapter.list_children(self.parent_ids)
+        self.assertEqual(sorted(child['id'] for child in children),
+            sorted('{}-{}'.format(parent_id, i) for parent_id in self.parent_ids for i in range(2)))
+
+        batches = [q for q, token in self.endpoint.queries if token is None]
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(batches[0].count('in parents'), gdrive_adapter.LIST_PARENTS_PER_QUERY)
+        self.assertEqual(batches[1].count('in parents'), 5)
+        # each batch holds more children than fit on a page
+        self.assertGreater(len(self.endpoint.queries), len(batches))
+
+    def test_trashed_children_are_left_out(self):
+        children = gdrive_adapter.list_children(['p0'], "mimeType != 'application/vnd.google-apps.folder'")
+        self.assertEqual([child['id'] for child in children], ['p0-0', 'p0-1'])
+        self.assertTrue(all('trashed = false' in q for q, token in self.endpoint.queries))
+
+if __name__ == '__main__':
+    unittest.main()
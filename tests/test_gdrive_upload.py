@@ -0,0 +1,101 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import gdrive_adapter
+except ImportError:
+    gdrive_adapter = None
+
+MiB = 1024 * 1024
+
+class FakeUploadRequest:
+
+    def __init__(self, endpoint, body, media):
+        self.endpoint = endpoint
+        self.body = body
+        self.media = media
+        self.resumable_uri = None
+        self.resumable_progress = 0
+
+    def execute(self):
+        self.endpoint.requests.append(('multipart', self.media.size()))
+        return self.endpoint.respond(self.body, self.media.size())
+
+    def next_chunk(self):
+        # the first call opens the session and sends the first chunk, two requests on the wire
+        if self.resumable_uri is None:
+            self.endpoint.requests.append(('session', 0))
+            self.resumable_uri = 'https://upload.example/session/1'
+        data = self.media.getbytes(self.resumable_progress, self.media.chunksize())
+        self.endpoint.requests.append(('chunk', len(data)))
+        self.resumable_progress += len(data)
+        if self.resumable_progress < self.media.size():
+            return SimpleNamespace(resumable_progress=self.resumable_progress), None
+        return None, self.endpoint.respond(self.body, self.resumable_progress)
+
+class FakeUploadEndpoint:
+
+    def __init__(self):
+        self.requests = []
+
+    def respond(self, body, size):
+        return {'id': 'id{}'.format(len(self.requests)), 'name': body.get('name', 'file'),
+            'mimeType': 'application/octet-stream', 'size': str(size)}
+
+    def files(self):
+        return SimpleNamespace(create=lambda body, media_body, fields: FakeUploadRequest(self, body, media_body))
+
+@unittest.skipIf(gdrive_adapter is None, 'the Google API client libraries are not installed')
+class UploadStrategyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp() + os.path.sep
+        os.makedirs(self.repo_path + '.pixync')
+        self.endpoint = FakeUploadEndpoint()
+        gdrive_adapter.local_repo_path = self.repo_path
+        gdrive_adapter.gdrive_repo_url = ['root', 'repo']
+        gdrive_adapter.quiet = True
+        self.get_thread_service = gdrive_adapter.get_thread_service
+        gdrive_adapter.get_thread_service = lambda: self.endpoint
+        self.dir = gdrive_adapter.RemoteNode('dir', 'dir', None, gdrive_adapter.FOLDER_MIME_TYPE)
+
+    def tearDown(self):
+        gdrive_adapter.get_thread_service = self.get_thread_service
+        gdrive_adapter.set_transfer_config({})
+        shutil.rmtree(self.repo_path)
+
+    def upload(self, name, size):
+        with open(self.repo_path + name, 'wb') as file:
+            file.write(os.urandom(size))
+        self.endpoint.requests = []
+        gdrive_adapter.start_progress(1, size)
+        gdrive_adapter.upload_file(name, self.dir, 'application/octet-stream')
+        return self.endpoint.requests
+
+    def test_small_file_is_one_multipart_request(self):
+        gdrive_adapter.set_transfer_config({})
+        self.assertEqual(self.upload('IMG_1.xmp', 2048), [('multipart', 2048)])
+
+    def test_large_file_goes_up_in_configured_chunks(self):
+        gdrive_adapter.set_transfer_config({'chunk-size': 1, 'multipart-threshold': 2})
+        requests = self.upload('IMG_1.CR3', 5 * MiB + 100)
+        self.assertEqual(requests, [('session', 0)] + [('chunk', MiB)] * 5 + [('chunk', 100)])
+        self.assertEqual(self.dir.children['IMG_1.CR3'].size, 5 * MiB + 100)
+
+    def test_default_chunks_keep_a_raw_to_a_few_requests(self):
+        gdrive_adapter.set_transfer_config({})
+        self.assertEqual(len(self.upload('IMG_1.CR3', 40 * MiB)), 3)
+
+    def test_chunk_size_is_rounded_to_256_kib(self):
+        for configured, expected in ((0.3, 256 * 1024), (1.1, MiB), (0.01, 256 * 1024), (32, 32 * MiB)):
+            with self.subTest(configured=configured):
+                gdrive_adapter.set_transfer_config({'chunk-size': configured})
+                self.assertEqual(gdrive_adapter.chunk_size, expected)
+
+if __name__ == '__main__':
+    unittest.main()
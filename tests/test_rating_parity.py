@@ -0,0 +1,72 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metadata_util
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rating_corpus') + os.path.sep
+
+XMP_RATINGS = {
+    'attribute.xmp': 3,
+    'element.xmp': 4,
+    'foreign_prefix.xmp': 2,
+    'no_rating.xmp': 0,
+    'rejected_single_quotes.xmp': -1,
+    'chunk_boundary.xmp': 5,
+}
+
+PP3_RATINGS = {
+    'rank.pp3': 4,
+    'rank_then_trash.pp3': -1,
+    'trash_then_rank.pp3': -1,
+    'keep_then_rank.pp3': 1,
+    'no_rank.pp3': 0,
+}
+
+def get_rating_pp3_two_pass(pp3_file):
+    # the reader the streaming one replaced: InTrash anywhere wins, then the first Rank
+    with open(pp3_file, 'r') as file:
+        for line in file:
+            if line.startswith("InTrash") and line.rstrip('\n').split('=')[1] == 'true':
+                return -1
+
+        file.seek(0)
+        for line in file:
+            if line.startswith("Rank"):
+                return int(line.rstrip('\n').split('=')[1])
+
+    return 0
+
+class RatingParityTest(unittest.TestCase):
+
+    def test_corpus_is_complete(self):
+        names = set(name for name in os.listdir(CORPUS_DIR) if not name.startswith('.'))
+        self.assertEqual(names, set(XMP_RATINGS) | set(PP3_RATINGS))
+
+    def test_chunk_boundary_straddles_first_read(self):
+        with open(CORPUS_DIR + 'chunk_boundary.xmp', 'rb') as file:
+            offset = file.read().index(b'xmp:Rating')
+        self.assertLess(offset, metadata_util.READ_CHUNK_SIZE)
+        self.assertGreater(offset + len(b'xmp:Rating="5"'), metadata_util.READ_CHUNK_SIZE)
+
+    def test_xmp_stream_matches_full_parse(self):
+        for name, rating in XMP_RATINGS.items():
+            with self.subTest(name=name):
+                self.assertEqual(metadata_util.get_rating_xmp(CORPUS_DIR + name), rating)
+                self.assertEqual(metadata_util.get_rating(CORPUS_DIR + name), rating)
+                if name != 'foreign_prefix.xmp':
+                    self.assertEqual(metadata_util.get_rating_xmp_stream(CORPUS_DIR + name), rating)
+
+    def test_xmp_stream_defers_foreign_prefix(self):
+        self.assertIsNone(metadata_util.get_rating_xmp_stream(CORPUS_DIR + 'foreign_prefix.xmp'))
+
+    def test_pp3_single_pass_matches_two_pass(self):
+        for name, rating in PP3_RATINGS.items():
+            with self.subTest(name=name):
+                self.assertEqual(get_rating_pp3_two_pass(CORPUS_DIR + name), rating)
+                self.assertEqual(metadata_util.get_rating_pp3(CORPUS_DIR + name), rating)
+                self.assertEqual(metadata_util.get_rating(CORPUS_DIR + name), rating)
+
+if __name__ == '__main__':
+    unittest.main()